@@ -0,0 +1,250 @@
+"""
+    End to end load harness for FAB views on the Flywheel backend.
+
+    Builds a sample FAB application with a Contact model listed through FlywheelInterface and the
+    addon's SecurityManager, seeds it, then drives login, list, search, edit and permission check
+    scenarios through Flask's test client from many threads in one or more processes.
+    Every request is timed and the DynamoDB calls it made are counted with the addon's metrics hooks.
+
+    Start DynamoDB Local (or install moto and use --backend moto) then run::
+
+        python benchmarks/load.py --processes 2 --threads 8 --duration 30
+"""
+import argparse
+import datetime
+import logging
+import multiprocessing
+import random
+import sys
+import threading
+import time
+import uuid
+
+from flask import Flask
+from flask_appbuilder import AppBuilder, ModelView
+from flywheel import Engine, Field
+
+from fab_addon_flywheel import metrics
+from fab_addon_flywheel.models import Model
+from fab_addon_flywheel.models.interface import FlywheelInterface
+from fab_addon_flywheel.security.manager import SecurityManager
+
+log = logging.getLogger(__name__)
+
+SCENARIOS = ('login', 'list', 'search', 'edit', 'permission')
+
+ADMIN_USERNAME = 'bench-admin'
+ADMIN_PASSWORD = 'bench-password'
+
+
+def gen_id():
+    return str(uuid.uuid4().hex)
+
+
+class Contact(Model):
+    id = Field(type=str, default=gen_id, hash_key=True)
+    name = Field(type=str)
+    email = Field(type=str)
+    notes = Field(type=str)
+    created_on = Field(type=datetime.datetime, default=datetime.datetime.now, time_bucket='day')
+
+
+def connect(args):
+    engine = Engine(namespace=[args.namespace])
+    if args.backend == 'moto':
+        engine.connect(args.region, access_key='bench', secret_key='bench')
+    else:
+        engine.connect(args.region, host=args.host, port=args.port, is_secure=False,
+                       access_key='bench', secret_key='bench')
+    return engine
+
+
+def start_backend(args):
+    """
+        Returns the started moto mock, moto is only needed for --backend moto
+    """
+    if args.backend != 'moto':
+        return None
+    try:
+        from moto import mock_dynamodb2
+    except ImportError:
+        sys.exit('--backend moto needs the moto package, or run DynamoDB Local and use --backend local')
+    mock = mock_dynamodb2()
+    mock.start()
+    return mock
+
+
+def create_app(args):
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY='bench',
+        WTF_CSRF_ENABLED=False,
+        ADDON_MANAGERS=['fab_addon_flywheel.manager.FlywheelAddOnManager'],
+        FLYWHEEL_METRICS_URL=None,
+        FLYWHEEL_SECURITY_CACHE={'maxsize': 1024, 'ttl': 60} if args.security_cache else None,
+    )
+    engine = connect(args)
+    engine.register(Contact)
+    appbuilder = AppBuilder(app, engine, security_manager_class=SecurityManager)
+
+    class ContactModelView(ModelView):
+        datamodel = FlywheelInterface(Contact, engine)
+        list_columns = ['name', 'email', 'created_on']
+        search_columns = ['name', 'email']
+        edit_columns = ['name', 'email', 'notes']
+
+    appbuilder.add_view(ContactModelView, 'Contacts')
+    return app, appbuilder
+
+
+def seed(appbuilder, contacts):
+    sm = appbuilder.sm
+    if sm.find_user(username=ADMIN_USERNAME) is None:
+        sm.add_user(ADMIN_USERNAME, 'Bench', 'Admin', 'bench@example.com', sm.find_role(sm.auth_role_admin),
+                    password=ADMIN_PASSWORD)
+    engine = appbuilder.get_session
+    existing = engine.scan(Contact).count()
+    items = [Contact(name='contact {0}'.format(i), email='contact{0}@example.com'.format(i), notes='x' * 200)
+             for i in range(existing, contacts)]
+    for start in range(0, len(items), 100):
+        engine.save(items[start:start + 100], overwrite=True)
+    return [contact.id for contact in engine.scan(Contact).all(attributes=['id'])]
+
+
+class Worker(object):
+    """
+        One simulated user, with its own test client and session cookie
+    """
+    def __init__(self, app, appbuilder, contact_ids, contacts):
+        self.app = app
+        self.sm = appbuilder.sm
+        self.client = app.test_client()
+        self.contact_ids = contact_ids
+        self.contacts = contacts
+        self.user = None
+
+    def login(self):
+        self.client.get('/logout/')
+        response = self.client.post('/login/', data={'username': ADMIN_USERNAME, 'password': ADMIN_PASSWORD})
+        return response.status_code
+
+    def list(self):
+        page = random.randint(0, max(0, self.contacts // 25 - 1))
+        return self.client.get('/contactmodelview/list/?page_ContactModelView={0}'.format(page)).status_code
+
+    def search(self):
+        name = 'contact {0}'.format(random.randint(0, self.contacts - 1))
+        return self.client.get('/contactmodelview/list/?_flt_0_name={0}'.format(name)).status_code
+
+    def edit(self):
+        pk = random.choice(self.contact_ids)
+        url = '/contactmodelview/edit/{0}'.format(pk)
+        self.client.get(url)
+        return self.client.post(url, data={'name': 'edited {0}'.format(pk[:8]), 'email': 'edited@example.com',
+                                           'notes': 'y' * 200}).status_code
+
+    def permission(self):
+        if self.user is None:
+            self.user = self.sm.find_user(username=ADMIN_USERNAME)
+        allowed = self.sm._has_view_access(self.user, 'can_list', 'ContactModelView')
+        return 200 if allowed else 403
+
+    def run(self, scenario):
+        with metrics.capture() as usage:
+            start = time.time()
+            try:
+                status = getattr(self, scenario)()
+            except Exception as e:
+                log.error("{0} failed: {1}".format(scenario, str(e)))
+                status = 599
+            latency = time.time() - start
+        return scenario, latency, usage.calls, status
+
+
+def run_worker(app, appbuilder, contact_ids, args, deadline, results):
+    worker = Worker(app, appbuilder, contact_ids, args.contacts)
+    worker.login()
+    while time.time() < deadline:
+        results.append(worker.run(random.choice(args.scenarios)))
+
+
+def run_process(args):
+    """
+        Runs args.threads simulated users until args.duration elapsed, returns their samples
+    """
+    mock = start_backend(args)
+    try:
+        app, appbuilder = create_app(args)
+        contact_ids = seed(appbuilder, args.contacts)
+        results = []
+        deadline = time.time() + args.duration
+        threads = [threading.Thread(target=run_worker, args=(app, appbuilder, contact_ids, args, deadline, results))
+                   for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+    finally:
+        if mock is not None:
+            mock.stop()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(results, elapsed):
+    print('{0:<12} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>11} {7:>7}'.format(
+        'scenario', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'calls/req', 'errors'))
+    for scenario in sorted(set(sample[0] for sample in results)) + ['total']:
+        samples = [sample for sample in results if scenario in ('total', sample[0])]
+        latencies = sorted(sample[1] for sample in samples)
+        errors = sum(1 for sample in samples if sample[3] >= 400)
+        print('{0:<12} {1:>8} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>11.2f} {7:>7}'.format(
+            scenario, len(samples), len(samples) / elapsed, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.95) * 1000, percentile(latencies, 0.99) * 1000,
+            float(sum(sample[2] for sample in samples)) / max(len(samples), 1), errors))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=('local', 'moto'), default='local',
+                        help='DynamoDB Local, or moto in memory (every process then has its own data)')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--namespace', default='bench-', help='Table name prefix')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4, help='Simulated users per process')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run')
+    parser.add_argument('--contacts', type=int, default=1000, help='Contacts to seed')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--security-cache', action='store_true', help='Enable FLYWHEEL_SECURITY_CACHE')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args(argv)
+    if args.backend == 'local':
+        # seed once, so processes don't race creating the tables
+        app, appbuilder = create_app(args)
+        seed(appbuilder, args.contacts)
+    start = time.time()
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        try:
+            results = [sample for samples in pool.map(run_process, [args] * args.processes) for sample in samples]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = run_process(args)
+    report(results, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
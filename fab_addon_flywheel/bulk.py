@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dynamo3 import CheckFailed, ThroughputException
+
+from fab_addon_flywheel import metrics
+from fab_addon_flywheel.cache import get_item_cache
+from fab_addon_flywheel.models import indexes, update_fields
+from fab_addon_flywheel.unit_of_work import UnitOfWork
+from fab_addon_flywheel.utils import CapacityBudget, KeySetQuery, get_key_names, parallel_scan
+
+log = logging.getLogger(__name__)
+
+
+def get_bulk_attributes(model, names=()):
+    """
+        The attributes a bulk action reads, the keys, the indexed fields (to keep their indexes
+        right), the version field and the given names
+    """
+    attributes = get_key_names(model)
+    fields = indexes.get_indexed_fields(model) + indexes.get_time_bucket_fields(model)
+    extra = [field.name for field in fields] + list(names)
+    if model.__version_field__:
+        extra.append(model.__version_field__)
+    return attributes + [name for name in extra if name not in attributes]
+
+
+def stream_items(engine, model, query, segments=4, attributes=None, max_buffer=1000):
+    """
+        Yields the items matching query holding only attributes, reading at most max_buffer
+        items ahead. Queries resolved to keys by a filter read them in batches of 100.
+    """
+    if isinstance(query, KeySetQuery):
+        if query.filtered:
+            query = query._scan()
+        else:
+            pk_name = model.meta_.hash_key.name
+            for start in range(0, len(query.keys), 100):
+                keys = [{pk_name: key} for key in query.keys[start:start + 100]]
+                for item in engine.get(model, keys):
+                    yield item
+            return
+    for raw in parallel_scan(query, segments, attributes=attributes, max_buffer=max_buffer):
+        yield model.ddb_load_(engine, raw)
+
+
+def _retry_throttled(func, max_retries=8):
+    delay = 0.05
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except ThroughputException:
+            if attempt == max_retries:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+
+
+class BulkAction(object):
+    """
+        Streams the items of a query into chunks that workers write concurrently,
+        holding at most workers * 2 chunks in memory and pacing the writes to a budget
+    """
+    def __init__(self, engine, model, workers=4, chunk_size=25, write_budget=None, progress=None):
+        """
+            :param write_budget: write units per second the action may consume, None for no limit
+            :param progress: optional callable getting the number of items of every written chunk,
+                like cli.Progress.add
+        """
+        self.engine = engine
+        self.model = model
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.budget = CapacityBudget(write_budget)
+        # the write budget needs the consumed capacity, even with metrics off
+        metrics.install(engine, collect=False)
+        self.progress = progress
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def write_chunk(self, items):
+        """
+            Writes a chunk, returns the number of items written
+        """
+        raise NotImplementedError
+
+    def _run_chunk(self, items):
+        with metrics.capture() as usage:
+            written = self.write_chunk(items)
+        # a write consumes at least one unit, when the connection does not return capacity
+        self.budget.spend(max(usage.write_units, written))
+        cache = get_item_cache(self.model)
+        if cache is not None:
+            for item in items:
+                cache.evict(item)
+        with self._lock:
+            self.count += written
+        if self.progress is not None:
+            self.progress(written)
+
+    def run(self, items):
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        futures = []
+
+        def run_chunk(chunk):
+            try:
+                self._run_chunk(chunk)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    slots.acquire()
+                    futures.append(executor.submit(run_chunk, chunk))
+                    chunk = []
+                    # drop the finished ones, so memory stays bounded on long runs
+                    done = set(future for future in futures if future.done())
+                    for future in done:
+                        future.result()
+                    futures = [future for future in futures if future not in done]
+            if chunk:
+                slots.acquire()
+                futures.append(executor.submit(run_chunk, chunk))
+            for future in futures:
+                future.result()
+        return self.count
+
+
+class BulkDelete(BulkAction):
+
+    def write_chunk(self, items):
+        changes = indexes.IndexChanges()
+        for item in items:
+            changes.extend(indexes.get_changes(item, deleted=True))
+
+        def write():
+            batch = UnitOfWork(self.engine)
+            batch.delete(*items)
+            batch.delete(*changes.deletes)
+            batch.flush()
+
+        _retry_throttled(write)
+        return len(items)
+
+
+class BulkUpdate(BulkAction):
+
+    def __init__(self, engine, model, values, **kwargs):
+        """
+            :param values: dict of field name to the value every item gets
+        """
+        super(BulkUpdate, self).__init__(engine, model, **kwargs)
+        self.values = values
+
+    def write_chunk(self, items):
+        written = 0
+        changes = indexes.IndexChanges()
+        for item in items:
+            for name, value in self.values.items():
+                setattr(item, name, value)
+            item_changes = indexes.get_changes(item)
+            try:
+                # only the given fields, and no resurrecting items deleted meanwhile
+                _retry_throttled(lambda: update_fields(item, self.values, self.model.__version_field__,
+                                                       must_exist=True, check_version=False))
+            except CheckFailed:
+                continue
+            changes.extend(item_changes)
+            written += 1
+        indexes.apply_changes(self.engine, changes)
+        return written
+
+
+def bulk_delete(engine, model, query, segments=4, **kwargs):
+    """
+        Deletes every item matching query in constant memory, see BulkAction for the options
+
+        :return: the number of deleted items
+    """
+    items = stream_items(engine, model, query, segments, get_bulk_attributes(model))
+    return BulkDelete(engine, model, **kwargs).run(items)
+
+
+def bulk_update(engine, model, query, values, segments=4, **kwargs):
+    """
+        Sets values on every item matching query in constant memory, see BulkAction for the options
+
+        :return: the number of updated items
+    """
+    items = stream_items(engine, model, query, segments, get_bulk_attributes(model))
+    return BulkUpdate(engine, model, values, **kwargs).run(items)
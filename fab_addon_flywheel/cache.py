@@ -0,0 +1,351 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+        Small thread safe LRU cache with an optional time to live, keeps hit/miss statistics
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _count=False) is not None
+
+    def get(self, key, default=None, _count=True):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    if _count:
+                        self.hits += 1
+                    return value
+                del self._data[key]
+                self.expirations += 1
+            if _count:
+                self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+class ItemCache:
+    """
+        Write-through cache of a model's items, keyed by primary key.
+
+        Items are kept in their dynamo representation and loaded into a fresh
+        model instance on every hit, so callers can never modify a cached item.
+        Lookups by another attribute (like a role name) are remembered as a
+        pointer to the primary key, and verified on every hit.
+    """
+    def __init__(self, model, maxsize=1024, ttl=None):
+        self.model = model
+        self.items = LRUCache(maxsize, ttl)
+        self.lookups = LRUCache(maxsize, ttl)
+
+    def _pk(self, item):
+        return getattr(item, self.model.meta_.hash_key.name)
+
+    def get(self, engine, pk_value):
+        data = self.items.get(pk_value)
+        if data is None:
+            return None
+        return self.model.ddb_load_(engine, data)
+
+    def get_many(self, engine, pk_values):
+        """
+            Returns a tuple of (found items, missing primary keys)
+        """
+        found, missing = [], []
+        for pk_value in pk_values:
+            item = self.get(engine, pk_value)
+            if item is None:
+                missing.append(pk_value)
+            else:
+                found.append(item)
+        return found, missing
+
+    def get_by(self, engine, field_name, value):
+        pk_value = self.lookups.get((field_name, value))
+        if pk_value is None:
+            return None
+        item = self.get(engine, pk_value)
+        if item is None or getattr(item, field_name) != value:
+            self.lookups.pop((field_name, value))
+            return None
+        return item
+
+    def put(self, item, *lookup_fields):
+        if item is None:
+            return item
+        pk_value = self._pk(item)
+        self.items.set(pk_value, item.ddb_dump_())
+        for field_name in lookup_fields:
+            self.lookups.set((field_name, getattr(item, field_name)), pk_value)
+        return item
+
+    def evict(self, item):
+        self.items.pop(self._pk(item))
+
+    def clear(self):
+        self.items.clear()
+        self.lookups.clear()
+
+    @property
+    def stats(self):
+        return {'items': self.items.stats, 'lookups': self.lookups.stats}
+
+
+_item_caches = {}
+
+
+def configure_item_cache(model, maxsize=1024, ttl=None):
+    """
+        Enables (or reconfigures) the item cache for a model
+
+        :param model: The flywheel model class
+        :param maxsize: Maximum number of items kept
+        :param ttl: Seconds an item is kept, None keeps it until evicted
+    """
+    cache = ItemCache(model, maxsize=maxsize, ttl=ttl)
+    _item_caches[model] = cache
+    return cache
+
+
+def disable_item_cache(model):
+    _item_caches.pop(model, None)
+
+
+def get_item_cache(model):
+    """
+        Returns the item cache for a model or None if the model does not use one.
+        Models opt in by setting ``__item_cache__`` to a dict of options,
+        for example ``__item_cache__ = {'maxsize': 512, 'ttl': 300}``.
+    """
+    if model is None:
+        return None
+    if not isinstance(model, type):
+        model = model.__class__
+    cache = _item_caches.get(model)
+    if cache is None:
+        options = getattr(model, '__item_cache__', None)
+        if options is not None:
+            cache = configure_item_cache(model, **options)
+    return cache
+
+
+def item_cache_stats():
+    return dict((model.__name__, cache.stats) for model, cache in _item_caches.items())
+
+
+class WriteVersions:
+    """
+        Per model write counters, every write through an interface bumps its model's
+        version so results cached under an older version are never served again
+    """
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, model):
+        return self._versions.get(model, 0)
+
+    def bump(self, *models):
+        with self._lock:
+            for model in models:
+                self._versions[model] = self._versions.get(model, 0) + 1
+
+
+write_versions = WriteVersions()
+
+
+def estimate_size(value):
+    """
+        Rough number of bytes held by a dumped item, a list of them or a read only row
+    """
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sys.getsizeof(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    slots = getattr(value, '__slots__', None)
+    if slots:
+        return sys.getsizeof(value) + sum(estimate_size(getattr(value, name, None)) for name in slots)
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """
+        Thread safe LRU cache of list results bounded by their estimated memory size.
+        Keys include the model's write version, so entries written before a write
+        are unreachable and age out of the cache.
+    """
+    def __init__(self, max_bytes=4 * 1024 * 1024, ttl=30):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, size, value = entry
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.bytes -= size
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self._data[key] = (expires, size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def copy_items(engine, result):
+    """
+        Returns fresh model instances for a model, a list of models or None
+    """
+    if result is None:
+        return None
+    if isinstance(result, list):
+        return [item.ddb_load_(engine, item.ddb_dump_()) for item in result]
+    return result.ddb_load_(engine, result.ddb_dump_())
+
+
+class SingleFlight:
+    """
+        Coalesces identical concurrent reads, while a read for a key is in flight
+        every other caller asking for the same key waits for it and shares its result.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, func, copy=None):
+        """
+            Runs func, or waits for the identical call already running
+
+            :param key: hashable description of the read
+            :param func: callable without arguments doing the read
+            :param copy: optional callable applied to the result handed to waiting callers,
+                so they don't share mutable objects with the caller that did the read
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy(call.result) if copy is not None else call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+single_flight = SingleFlight()
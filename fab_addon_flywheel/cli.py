@@ -0,0 +1,235 @@
+import base64
+import gzip
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import click
+from dynamo3 import Binary, ThroughputException
+
+from fab_addon_flywheel.bulk import bulk_delete, bulk_update
+from fab_addon_flywheel.utils import parallel_scan
+
+log = logging.getLogger(__name__)
+
+
+def encode_value(value):
+    """
+        Converts a raw dynamo value to something json can write, keeping its dynamo type
+    """
+    if isinstance(value, Decimal):
+        return {'$n': str(value)}
+    if isinstance(value, Binary):
+        return {'$b': base64.b64encode(value.value).decode('ascii')}
+    if isinstance(value, bytes):
+        return {'$b': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, (set, frozenset)):
+        return {'$set': [encode_value(v) for v in value]}
+    if isinstance(value, dict):
+        return dict((k, encode_value(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if '$n' in value:
+                return Decimal(value['$n'])
+            if '$b' in value:
+                return Binary(base64.b64decode(value['$b']))
+            if '$set' in value:
+                return set(decode_value(v) for v in value['$set'])
+        return dict((k, decode_value(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    return value
+
+
+class Progress(object):
+    """
+        Thread safe item counter that reports throughput every `every` items
+    """
+    def __init__(self, label, every=10000):
+        self.label = label
+        self.every = every
+        self.count = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, count=1):
+        with self._lock:
+            before = self.count
+            self.count += count
+            if self.count // self.every != before // self.every:
+                self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        click.echo('{0}: {1} items in {2:.1f}s ({3:.0f} items/s)'.format(
+            self.label, self.count, elapsed, self.count / elapsed), err=True)
+
+
+def get_model(engine, name):
+    model = engine.models.get(name)
+    if model is None:
+        raise click.BadParameter('Unknown model {0}, registered models are: {1}'.format(
+            name, ', '.join(sorted(engine.models))))
+    return model
+
+
+def dump_model(engine, model, output, segments=4):
+    """
+        Writes every item of model to output as gzip compressed JSON lines, read with parallel scan segments
+    """
+    progress = Progress('dump {0}'.format(model.meta_.name))
+    with gzip.open(output, 'wt') as out:
+        for item in parallel_scan(engine.scan(model), segments):
+            out.write(json.dumps(encode_value(item), separators=(',', ':')))
+            out.write('\n')
+            progress.add()
+    progress.report()
+    return progress.count
+
+
+def _write_chunk(engine, tablename, items, progress, max_retries=8):
+    delay = 0.05
+    for attempt in range(max_retries + 1):
+        try:
+            with engine.dynamo.batch_write(tablename) as batch:
+                for item in items:
+                    batch.put(item)
+            progress.add(len(items))
+            return
+        except ThroughputException:
+            if attempt == max_retries:
+                raise
+            log.warning("Throttled writing to {0}, retrying in {1:.2f}s".format(tablename, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+
+
+def restore_model(engine, model, source, workers=4, chunk_size=500):
+    """
+        Writes the items of a dump made by dump_model back to the model's table with batch writes,
+        retrying throttled chunks with exponential backoff
+    """
+    tablename = model.meta_.ddb_tablename(engine.namespace)
+    progress = Progress('restore {0}'.format(model.meta_.name))
+    # bound the chunks in memory to what the workers can take
+    slots = threading.BoundedSemaphore(workers * 2)
+    futures = []
+
+    def write(chunk):
+        try:
+            _write_chunk(engine, tablename, chunk, progress)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunk = []
+        with gzip.open(source, 'rt') as src:
+            for line in src:
+                if not line.strip():
+                    continue
+                chunk.append(decode_value(json.loads(line)))
+                if len(chunk) >= chunk_size:
+                    slots.acquire()
+                    futures.append(executor.submit(write, chunk))
+                    chunk = []
+        if chunk:
+            slots.acquire()
+            futures.append(executor.submit(write, chunk))
+        for future in futures:
+            future.result()
+    progress.report()
+    return progress.count
+
+
+def parse_conditions(conditions):
+    """
+        Parses name=value options into a dict, values are read as JSON when they can be
+    """
+    result = {}
+    for condition in conditions:
+        name, sep, value = condition.partition('=')
+        if not sep:
+            raise click.BadParameter('Expected name=value, got {0}'.format(condition))
+        try:
+            result[name] = json.loads(value)
+        except ValueError:
+            result[name] = value
+    return result
+
+
+def register_commands(appbuilder):
+    """
+        Adds the ``flask flywheel`` command group to the application
+    """
+    app = appbuilder.get_app
+
+    @click.group('flywheel')
+    def flywheel_cli():
+        """ Flywheel tables maintenance """
+
+    @flywheel_cli.command('models')
+    def models():
+        """ Lists the registered models """
+        for name in sorted(appbuilder.get_session.models):
+            click.echo(name)
+
+    @flywheel_cli.command('dump')
+    @click.argument('model_name')
+    @click.option('--output', '-o', default=None, help='Output file, defaults to <model>.jsonl.gz')
+    @click.option('--segments', '-s', default=4, help='Parallel scan segments')
+    def dump(model_name, output, segments):
+        """ Dumps a model's table to compressed JSON lines """
+        engine = appbuilder.get_session
+        model = get_model(engine, model_name)
+        dump_model(engine, model, output or '{0}.jsonl.gz'.format(model_name), segments)
+
+    @flywheel_cli.command('restore')
+    @click.argument('model_name')
+    @click.argument('source')
+    @click.option('--workers', default=4, help='Parallel batch writers')
+    def restore(model_name, source, workers):
+        """ Restores a dump made by the dump command """
+        engine = appbuilder.get_session
+        model = get_model(engine, model_name)
+        restore_model(engine, model, source, workers)
+
+    @flywheel_cli.command('delete')
+    @click.argument('model_name')
+    @click.option('--where', '-w', multiple=True, help='name=value, items must match all of them')
+    @click.option('--workers', default=4, help='Parallel batch writers')
+    @click.option('--write-budget', type=float, default=None, help='Write units per second')
+    @click.confirmation_option(prompt='Delete every matching item?')
+    def delete(model_name, where, workers, write_budget):
+        """ Deletes the items matching the conditions, all of them without conditions """
+        engine = appbuilder.get_session
+        model = get_model(engine, model_name)
+        progress = Progress('delete {0}'.format(model_name))
+        bulk_delete(engine, model, engine.scan(model).filter(**parse_conditions(where)), workers=workers,
+                    write_budget=write_budget, progress=progress.add)
+        progress.report()
+
+    @flywheel_cli.command('update')
+    @click.argument('model_name')
+    @click.option('--set', 'values', multiple=True, required=True, help='name=value to set')
+    @click.option('--where', '-w', multiple=True, help='name=value, items must match all of them')
+    @click.option('--workers', default=4, help='Parallel writers')
+    @click.option('--write-budget', type=float, default=None, help='Write units per second')
+    def update(model_name, values, where, workers, write_budget):
+        """ Sets values on the items matching the conditions, to backfill a field for example """
+        engine = appbuilder.get_session
+        model = get_model(engine, model_name)
+        progress = Progress('update {0}'.format(model_name))
+        bulk_update(engine, model, engine.scan(model).filter(**parse_conditions(where)), parse_conditions(values),
+                    workers=workers, write_budget=write_budget, progress=progress.add)
+        progress.report()
+
+    app.cli.add_command(flywheel_cli)
@@ -1,9 +1,29 @@
 import logging
+from flask import Response
+from flask_appbuilder import BaseView, expose
 from flask_appbuilder.basemanager import BaseManager
+from flask_appbuilder.security.decorators import has_access
+
+from fab_addon_flywheel import metrics, unit_of_work
+from fab_addon_flywheel.cli import register_commands
+from fab_addon_flywheel.warmup import start_warm_up
 
 log = logging.getLogger(__name__)
 
 
+class FlywheelMetricsView(BaseView):
+    """
+        Serves the metrics registry to the roles granted can_show on FlywheelMetricsView
+    """
+    default_view = 'show'
+    exporter = None
+
+    @expose('/')
+    @has_access
+    def show(self):
+        return Response(self.exporter.render(metrics.registry), content_type=self.exporter.content_type)
+
+
 class FlywheelAddOnManager(BaseManager):
 
     def __init__(self, appbuilder):
@@ -11,15 +31,36 @@ class FlywheelAddOnManager(BaseManager):
              Use the constructor to setup any config keys specific for your app.
         """
         super(FlywheelAddOnManager, self).__init__(appbuilder)
+        app = appbuilder.get_app
+        app.config.setdefault('FLYWHEEL_METRICS', True)
+        app.config.setdefault('FLYWHEEL_METRICS_URL', None)
+        app.config.setdefault('FLYWHEEL_METRICS_EXPORTER', metrics.PrometheusExporter)
+        app.config.setdefault('FLYWHEEL_UNIT_OF_WORK', False)
+        app.config.setdefault('FLYWHEEL_WARMUP', False)
+        app.config.setdefault('FLYWHEEL_WARMUP_MODELS', [])
+        app.config.setdefault('FLYWHEEL_WARMUP_JITTER', 5)
+        app.config.setdefault('FLYWHEEL_WARMUP_READ_BUDGET', 50)
+        register_commands(appbuilder)
+        metrics.install(appbuilder.get_session, collect=app.config['FLYWHEEL_METRICS'])
+        if app.config['FLYWHEEL_UNIT_OF_WORK']:
+            unit_of_work.install(app, appbuilder.get_session)
 
     def register_views(self):
         """
             This method is called by AppBuilder when initializing, use it to add you views
         """
-        pass
+        config = self.appbuilder.get_app.config
+        if config['FLYWHEEL_METRICS'] and config['FLYWHEEL_METRICS_URL']:
+            view = FlywheelMetricsView()
+            view.route_base = config['FLYWHEEL_METRICS_URL'].rstrip('/')
+            view.exporter = config['FLYWHEEL_METRICS_EXPORTER']()
+            self.appbuilder.add_view_no_menu(view)
 
     def pre_process(self):
         pass
 
     def post_process(self):
-        pass
+        config = self.appbuilder.get_app.config
+        if config['FLYWHEEL_WARMUP']:
+            start_warm_up(self.appbuilder, config['FLYWHEEL_WARMUP_MODELS'], config['FLYWHEEL_WARMUP_JITTER'],
+                          config['FLYWHEEL_WARMUP_READ_BUDGET'])
@@ -0,0 +1,311 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from dynamo3 import ThroughputException
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def percentile(self, q):
+        """
+            Estimates the q (0 to 1) percentile as the upper bound of the bucket it falls in
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for i, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class MetricsRegistry(object):
+    """
+        Process wide metrics, identified by name and labels
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = cls()
+                    self._metrics[key] = metric
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        return self._get(Histogram, name, labels)
+
+    def collect(self):
+        """
+            Returns a sorted list of (name, labels, metric)
+        """
+        with self._lock:
+            items = list(self._metrics.items())
+        return sorted(((name, dict(labels), metric) for (name, labels), metric in items),
+                      key=lambda item: (item[0], sorted(item[1].items())))
+
+    def snapshot(self):
+        """
+            Returns a dict of metric name to a list of labels and values, histograms
+            come with their p50, p95 and p99 estimates
+        """
+        result = {}
+        for name, labels, metric in self.collect():
+            if metric.kind == 'histogram':
+                value = {'count': metric.count, 'sum': metric.sum, 'p50': metric.percentile(0.5),
+                         'p95': metric.percentile(0.95), 'p99': metric.percentile(0.99)}
+            else:
+                value = metric.value
+            result.setdefault(name, []).append((labels, value))
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+registry = MetricsRegistry()
+
+_local = threading.local()
+
+
+def _operations():
+    operations = getattr(_local, 'operations', None)
+    if operations is None:
+        operations = _local.operations = []
+    return operations
+
+
+def _captures():
+    captures = getattr(_local, 'captures', None)
+    if captures is None:
+        captures = _local.captures = []
+    return captures
+
+
+def _current_labels():
+    operations = _operations()
+    if operations:
+        return operations[-1]
+    return {'operation': 'other', 'model': 'unknown'}
+
+
+class Capture(object):
+    """
+        Totals of the dynamo calls made by the current thread inside a capture() block
+    """
+    def __init__(self):
+        self.calls = 0
+        self.returned = 0
+        self.scanned = 0
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self.retries = 0
+
+
+@contextmanager
+def capture():
+    """
+        Collects the calls, items and consumed capacity of the dynamo calls made in the block
+    """
+    result = Capture()
+    captures = _captures()
+    captures.append(result)
+    try:
+        yield result
+    finally:
+        captures.remove(result)
+
+
+@contextmanager
+def operation(name, model):
+    """
+        Times a data layer operation and attributes the dynamo calls made in the block to it
+    """
+    labels = {'operation': name, 'model': getattr(model, '__name__', str(model))}
+    operations = _operations()
+    operations.append(labels)
+    start = time.time()
+    try:
+        yield
+    except ThroughputException:
+        registry.counter('flywheel_throttles_total', **labels).inc()
+        raise
+    except Exception:
+        registry.counter('flywheel_errors_total', **labels).inc()
+        raise
+    finally:
+        operations.pop()
+        registry.histogram('flywheel_operation_seconds', **labels).observe(time.time() - start)
+
+
+def instrumented(name, model_attr='obj'):
+    """
+        Decorator for methods of objects holding the model in model_attr, times every call
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with operation(name, getattr(self, model_attr, None)):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _on_precall(connection, command, kwargs):
+    if id(connection) in _collecting:
+        registry.counter('flywheel_dynamo_calls_total', command=command, **_current_labels()).inc()
+    for result in _captures():
+        result.calls += 1
+
+
+def _on_postcall(connection, command, kwargs, response):
+    returned = response.get('Count', 0) if isinstance(response, dict) else 0
+    scanned = response.get('ScannedCount', 0) if isinstance(response, dict) else 0
+    if id(connection) in _collecting:
+        labels = _current_labels()
+        if returned:
+            registry.counter('flywheel_items_returned_total', **labels).inc(returned)
+        if scanned:
+            registry.counter('flywheel_items_scanned_total', **labels).inc(scanned)
+    for result in _captures():
+        result.returned += returned
+        result.scanned += scanned
+
+
+def _on_capacity(connection, command, kwargs, response, capacity):
+    read_units = getattr(capacity, 'read', None)
+    write_units = getattr(capacity, 'write', None)
+    read_units = getattr(read_units, 'total', read_units) or 0
+    write_units = getattr(write_units, 'total', write_units) or 0
+    if id(connection) in _collecting:
+        labels = _current_labels()
+        if read_units:
+            registry.counter('flywheel_consumed_read_units_total', **labels).inc(read_units)
+        if write_units:
+            registry.counter('flywheel_consumed_write_units_total', **labels).inc(write_units)
+    for result in _captures():
+        result.read_units += read_units
+        result.write_units += write_units
+
+
+def _count_retries(connection):
+    """
+        dynamo3 retries throttled calls inside Connection.call, unseen by the hooks,
+        but it sleeps through exponential_sleep before every retry
+    """
+    sleep = connection.exponential_sleep
+
+    def exponential_sleep(attempt):
+        if id(connection) in _collecting:
+            registry.counter('flywheel_dynamo_retries_total', **_current_labels()).inc()
+        for result in _captures():
+            result.retries += 1
+        return sleep(attempt)
+
+    connection.exponential_sleep = exponential_sleep
+
+
+_installed = set()
+_collecting = set()
+
+
+def install(engine, collect=True):
+    """
+        Subscribes the metrics hooks to the engine's dynamo connection. They always feed
+        capture() blocks, that page sizing and the read and write budgets rely on,
+        and with collect the process wide registry too.
+    """
+    connection = engine.dynamo
+    if collect:
+        _collecting.add(id(connection))
+    if id(connection) in _installed:
+        return
+    _installed.add(id(connection))
+    connection.default_return_capacity = True
+    connection.subscribe('precall', _on_precall)
+    connection.subscribe('postcall', _on_postcall)
+    connection.subscribe('capacity', _on_capacity)
+    _count_retries(connection)
+
+
+class Exporter(object):
+    """
+        Renders the registry for a metrics endpoint, subclass it to export another format
+    """
+    content_type = 'text/plain'
+
+    def render(self, registry):
+        raise NotImplementedError
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+class PrometheusExporter(Exporter):
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def render(self, registry):
+        lines = []
+        typed = set()
+        for name, labels, metric in registry.collect():
+            if name not in typed:
+                lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+                typed.add(name)
+            if metric.kind == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), metric.counts):
+                    cumulative += count
+                    bucket_labels = dict(labels, le='+Inf' if bound == float('inf') else repr(bound))
+                    lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(bucket_labels), cumulative))
+                lines.append('{0}_sum{1} {2}'.format(name, _format_labels(labels), metric.sum))
+                lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), metric.count))
+            else:
+                lines.append('{0}{1} {2}'.format(name, _format_labels(labels), metric.value))
+        return '\n'.join(lines) + '\n'
@@ -1,5 +1,92 @@
+from dynamo3 import ALL_NEW, CheckFailed
 from flywheel import Model as BaseModel
 
+from fab_addon_flywheel.cache import copy_items, get_item_cache, single_flight
+from fab_addon_flywheel.utils import is_consistent
+
+
+def merge_changes(item, fresh):
+    """
+        Default merge of a version conflict, applies the fields item changed since it was loaded
+        on top of fresh. Returns None, giving up, if fresh changed one of them too.
+    """
+    for name in item.meta_.fields:
+        if name == item.__version_field__:
+            continue
+        value = getattr(item, name)
+        loaded = item.cached_(name)
+        if value == loaded:
+            continue
+        if getattr(fresh, name) != loaded:
+            return None
+        setattr(fresh, name, value)
+    return fresh
+
+
+def get_changed_fields(item):
+    """
+        Returns the names of the fields item changed since it was loaded, as flywheel's sync sees them
+    """
+    names = set(item.__dirty__) | set(item.__incrs__)
+    for name, field in item.meta_.fields.items():
+        if name not in names and field.is_mutable and field.resolve(item) != item.cached_(name):
+            names.update(item.meta_.related_fields[name])
+    return names
+
+
+def update_fields(item, names, version_name=None, expected=None, must_exist=False, check_version=True):
+    """
+        Writes the fields names of item with a single UpdateItem expression, and loads the
+        updated item back into it. Key fields are skipped.
+
+        :param version_name: a version field to increment, on the condition that it still holds expected
+            (that it is absent when expected is None)
+        :param must_exist: fail instead of creating the item if it was deleted meanwhile
+        :param check_version: False increments version_name whatever it holds
+        :raises CheckFailed: when a condition doesn't hold
+    """
+    engine = item.engine
+    key_names = set(item.pk_dict_)
+    names = sorted(set(names) - key_names - set([version_name]))
+    # only the written fields, bulk items are projected and miss the others
+    for name in names:
+        item.meta_.fields[name].validate(item)
+    alias, values, sets, removes, conditions = {}, {}, [], [], []
+    for i, name in enumerate(names):
+        alias['#f{0}'.format(i)] = name
+        value = item.ddb_dump_field_(name)
+        if value is None:
+            removes.append('#f{0}'.format(i))
+        else:
+            values[':f{0}'.format(i)] = value
+            sets.append('#f{0} = :f{0}'.format(i))
+    expression = []
+    if sets:
+        expression.append('SET ' + ', '.join(sets))
+    if removes:
+        expression.append('REMOVE ' + ', '.join(removes))
+    if version_name:
+        alias['#v'] = version_name
+        values[':one'] = 1
+        expression.append('ADD #v :one')
+        if check_version and expected is None:
+            conditions.append('attribute_not_exists(#v)')
+        elif check_version:
+            values[':v'] = expected
+            conditions.append('#v = :v')
+    if must_exist:
+        alias['#k'] = item.meta_.hash_key.name
+        conditions.append('attribute_exists(#k)')
+    if not expression:
+        return item
+    result = engine.dynamo.update_item2(
+        item.meta_.ddb_tablename(engine.namespace), item.pk_dict_, ' '.join(expression),
+        expr_values=values or None, alias=alias, condition=' AND '.join(conditions) or None, returns=ALL_NEW)
+    with item.loading_(engine):
+        for key, value in result.items():
+            item.set_ddb_val_(key, value)
+    return item
+
 
 class Model(BaseModel):
 
@@ -7,29 +94,95 @@ class Model(BaseModel):
         '_abstract': True,
     }
 
+    __item_cache__ = None
+    """ Set to a dict of options, like {'maxsize': 512, 'ttl': 300}, to cache this model's items """
+
+    __read_consistency__ = None
+    """ Set to a dict of read kind to read mode, like {'list': 'strong'}, to override the defaults """
+
+    __version_field__ = None
+    """ Name of an int field, declared without a default, to edit with sync_versioned """
+
     @property
     def engine(self):
         return self.__engine__
 
+    def _copy_related(self, result):
+        return copy_items(self.engine, result)
+
     def get_related_models(self, field_name):
-        prop = self.field_(field_name)
-        model = self.engine.models.get(prop.metadata.get('model'))
+        field = self.field_(field_name)
+        value = getattr(self, field_name)
+        model = self.engine.models.get(field.metadata.get('model'))
         pk_name = model.meta_.hash_key.name
-        if prop.is_set:
-            return self.engine.query(model).filter(model.field_(pk_name).in_(prop)).all()
+        cache = get_item_cache(model)
+        if field.is_set:
+            if not value:
+                return []
+            found, missing = [], list(value)
+            if cache is not None:
+                found, missing = cache.get_many(self.engine, missing)
+            if missing:
+                consistent = is_consistent('relation', model)
+                fetched = single_flight.do(
+                    ('related', model.meta_.name, tuple(sorted(missing)), consistent),
+                    lambda: self.engine.query(model).filter(model.field_(pk_name).in_(missing)).all(
+                        consistent=consistent),
+                    self._copy_related)
+                if cache is not None:
+                    for item in fetched:
+                        cache.put(item)
+                found.extend(fetched)
+            return found
         else:
-            return self.engine.query(model).filter(getattr(model, pk_name) == prop).first()
+            if value is None:
+                return None
+            if cache is not None:
+                item = cache.get(self.engine, value)
+                if item is not None:
+                    return item
+            consistent = is_consistent('relation', model)
+            item = single_flight.do(
+                ('related', model.meta_.name, (value,), consistent),
+                lambda: self.engine.query(model).filter(getattr(model, pk_name) == value).first(
+                    consistent=consistent),
+                self._copy_related)
+            if cache is not None:
+                cache.put(item)
+            return item
 
-    def set_related_models(self, field_name, items):
-        prop = self.field_(field_name)
-        model = self.engine.models.get(prop.metadata.get('model'))
-        pk_name = model.meta_.hash_key.name
+    def sync_versioned(self, merge=merge_changes, retries=3, before_write=None):
+        """
+            Saves the changed fields with a single condition, that the version field still holds
+            the loaded value, and increments it. On a conflict the item is read again and
+            merge(item, fresh) returns the item to retry with, or None to give up.
 
-        if prop.is_set:
-            for item in items:
-                if getattr(item, pk_name) not in prop:
-                    prop.add(getattr(item, pk_name))
-        else:
-            prop = getattr(items, pk_name)
-        return prop
+            :param before_write: optional callable getting the item about to be written, on every
+                attempt, to compute what depends on its loaded values like index changes
+            :return: the saved item, this one or the merged one
+        """
+        item = self
+        name = self.__version_field__
+        for attempt in range(retries + 1):
+            if before_write is not None:
+                before_write(item)
+            try:
+                return update_fields(item, get_changed_fields(item), name, expected=item.cached_(name))
+            except CheckFailed:
+                if merge is None or attempt == retries:
+                    raise
+                fresh = item.engine.get(item.__class__, consistent=True, **item.pk_dict_)
+                merged = merge(item, fresh) if fresh is not None else None
+                if merged is None:
+                    raise
+                item = merged
 
+    def set_related_models(self, field_name, items):
+        field = self.field_(field_name)
+        if field.is_set:
+            value = set(getattr(item, item.meta_.hash_key.name) for item in items or ())
+        else:
+            value = None if items is None else getattr(items, items.meta_.hash_key.name)
+        # reverse indexes follow when the item is written, from the loaded and the new value
+        setattr(self, field_name, value)
+        return value
@@ -1,7 +1,10 @@
+import datetime
 import logging
 from flask_babel import lazy_gettext
 from flask_appbuilder.models.filters import BaseFilter, FilterRelation, BaseFilterConverter
 
+from fab_addon_flywheel.utils import KeySetQuery, query_signature
+
 log = logging.getLogger(__name__)
 
 __all__ = [
@@ -46,10 +49,59 @@ class FilterNotEqual(BaseFlywheelFilter):
         return query.filter(self.field != value)
 
 
+def _range_condition(flt, after, before):
+    if after is None:
+        return flt.field < before
+    if before is None:
+        return flt.field > after
+    # a flywheel condition holds one operator per field, and between_ is inclusive, so move
+    # the ends in by the smallest step of the type to keep both comparisons strict
+    step = datetime.timedelta(days=1) if flt.datamodel.is_date(flt.column_name) else \
+        datetime.timedelta(microseconds=1)
+    return flt.field.between_(after + step, before - step)
+
+
+def apply_time_range(flt, query, after=None, before=None):
+    """
+        Filters the datetime or date column of flt strictly between after and before, reading the
+        keys from the column's time bucket index when it has one. The bound of an earlier range
+        filter on the same column is merged in, so 'Greater Than' and 'Smaller Than' together only
+        read the buckets between them, whatever their order.
+    """
+    bounds = getattr(query, 'time_range', None)
+    if bounds is not None and bounds[0] == flt.column_name:
+        after = bounds[1] if after is None else after
+        before = bounds[2] if before is None else before
+        if isinstance(query, KeySetQuery):
+            query = query.base
+        elif query_signature(query) == query_signature(
+                query.engine.scan(query.model).filter(_range_condition(flt, bounds[1], bounds[2]))):
+            # only the earlier bound was applied, start over so the keys alone answer it
+            query = query.engine.scan(query.model)
+    condition = _range_condition(flt, after, before)
+    if after is not None and not isinstance(query, KeySetQuery) and flt.datamodel.is_datetime(flt.column_name):
+        owner_ids = flt.datamodel.get_time_range_ids(flt.column_name, after=after, before=before)
+        if owner_ids is not None:
+            query = KeySetQuery(query, owner_ids, fallback=condition)
+            query.time_range = (flt.column_name, after, before)
+            return query
+    query = query.filter(condition)
+    if not isinstance(query, KeySetQuery):
+        # an open start can't use the index, remember it for a 'Greater Than' that may follow
+        query.time_range = (flt.column_name, after, before)
+    return query
+
+
+def _is_time_column(flt):
+    return flt.datamodel.is_datetime(flt.column_name) or flt.datamodel.is_date(flt.column_name)
+
+
 class FilterGreater(BaseFlywheelFilter):
     name = lazy_gettext('Greater Than')
 
     def apply(self, query, value):
+        if _is_time_column(self):
+            return apply_time_range(self, query, after=value)
         return query.filter(self.field > value)
 
 
@@ -64,6 +116,8 @@ class FilterSmaller(BaseFlywheelFilter):
     name = lazy_gettext('Smaller Than')
 
     def apply(self, query, value):
+        if _is_time_column(self):
+            return apply_time_range(self, query, before=value)
         return query.filter(self.field < value)
 
 
@@ -116,16 +170,17 @@ class FilterRelationOneToManyEqual(FilterRelation, BaseFlywheelFilter):
     name = lazy_gettext('Relation')
 
     def apply(self, query, value):
-        rel_obj = self.datamodel.get_related_obj(self.column_name, value)
-        return query.filter(self.field == rel_obj)
+        return query.filter(self.field == value)
 
 
 class FilterRelationManyToManyEqual(FilterRelation, BaseFlywheelFilter):
     name = lazy_gettext('Relation as Many')
 
     def apply(self, query, value):
-        rel_obj = self.datamodel.get_related_obj(self.column_name, value)
-        return query.filter(self.field == rel_obj)
+        owner_ids = self.datamodel.get_reverse_ids(self.column_name, value)
+        if owner_ids is None:
+            return query.filter(self.field.contains_(value))
+        return KeySetQuery(query, owner_ids, fallback=self.field.contains_(value))
 
 
 class FilterEqualFunction(BaseFlywheelFilter):
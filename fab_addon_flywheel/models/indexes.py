@@ -0,0 +1,259 @@
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flywheel import Field
+
+from fab_addon_flywheel.models import Model
+
+log = logging.getLogger(__name__)
+
+
+class Membership(Model):
+    """
+        Adjacency item of a set relation, one per (related id, owner id) pair.
+        Answers "which owners hold this related id" with a Query instead of a scan.
+    """
+    __metadata__ = {
+        '_name': 'fab_membership',
+    }
+    key = Field(type=str, hash_key=True)
+    owner_id = Field(type=str, range_key=True)
+
+
+class TimeBucket(Model):
+    """
+        Index item of a datetime field, partitioned by day or hour and sorted by the timestamp.
+        Answers "which items have a value in this range" with one Query per bucket instead of a scan.
+    """
+    __metadata__ = {
+        '_name': 'fab_time_bucket',
+    }
+    bucket = Field(type=str, hash_key=True)
+    ts_key = Field(type=str, range_key=True)
+
+
+def membership_key(model, field_name, related_id):
+    return u'{0}.{1}:{2}'.format(model.meta_.name, field_name, related_id)
+
+
+def get_indexed_fields(model):
+    """
+        Returns the set relation fields declared with ``reverse_index=True``, like::
+
+            role_ids = Field(type=set_(str), model='Role', reverse_index=True)
+    """
+    return [field for field in model.meta_.fields.values()
+            if field.is_set and 'model' in field.metadata and field.metadata.get('reverse_index')]
+
+
+def has_reverse_index(model, field_name):
+    field = model.meta_.fields.get(field_name)
+    return field is not None and field in get_indexed_fields(model)
+
+
+class IndexChanges(object):
+    """
+        Index items to write and to delete for one or more item writes
+    """
+    def __init__(self):
+        self.puts = []
+        self.deletes = []
+
+    def __bool__(self):
+        return bool(self.puts or self.deletes)
+
+    __nonzero__ = __bool__
+
+    def extend(self, other):
+        self.puts.extend(other.puts)
+        self.deletes.extend(other.deletes)
+
+
+def _membership_changes(item, deleted, changes, rebuild=False):
+    model = item.__class__
+    owner_id = getattr(item, model.meta_.hash_key.name)
+    for field in get_indexed_fields(model):
+        current = set() if deleted else set(getattr(item, field.name) or ())
+        previous = set() if rebuild else set(item.cached_(field.name) or ())
+        for related_id in current - previous:
+            changes.puts.append(Membership(key=membership_key(model, field.name, related_id), owner_id=owner_id))
+        for related_id in previous - current:
+            changes.deletes.append(Membership(key=membership_key(model, field.name, related_id), owner_id=owner_id))
+
+
+def membership_changes(model, field_name, owner_id, added=(), removed=()):
+    """
+        Index changes for an atomic add or remove on a set relation (see Model.add_ and Model.remove_)
+    """
+    changes = IndexChanges()
+    if has_reverse_index(model, field_name):
+        for related_id in added:
+            changes.puts.append(Membership(key=membership_key(model, field_name, related_id), owner_id=owner_id))
+        for related_id in removed:
+            changes.deletes.append(Membership(key=membership_key(model, field_name, related_id), owner_id=owner_id))
+    return changes
+
+
+TIME_BUCKETS = {
+    'day': ('%Y-%m-%d', datetime.timedelta(days=1)),
+    'hour': ('%Y-%m-%dT%H', datetime.timedelta(hours=1)),
+}
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+max_time_buckets = 400
+""" Ranges spanning more buckets than this are scanned instead """
+
+
+def get_time_bucket_fields(model):
+    """
+        Returns the datetime fields declared with ``time_bucket='day'`` or ``time_bucket='hour'``, like::
+
+            created_on = Field(type=datetime, default=datetime.now, time_bucket='day')
+    """
+    return [field for field in model.meta_.fields.values() if field.metadata.get('time_bucket') in TIME_BUCKETS]
+
+
+def has_time_bucket(model, field_name):
+    field = model.meta_.fields.get(field_name)
+    return field is not None and field in get_time_bucket_fields(model)
+
+
+def _naive_utc(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _bucket_floor(value, size):
+    if size == 'day':
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def time_bucket_key(model, field_name, size, value):
+    return u'{0}.{1}:{2}'.format(model.meta_.name, field_name, value.strftime(TIME_BUCKETS[size][0]))
+
+
+def _time_bucket_item(model, field, owner_id, value):
+    value = _naive_utc(value)
+    return TimeBucket(bucket=time_bucket_key(model, field.name, field.metadata['time_bucket'], value),
+                      ts_key=u'{0}|{1}'.format(value.strftime(TIMESTAMP_FORMAT), owner_id))
+
+
+def _time_bucket_changes(item, deleted, changes, rebuild=False):
+    model = item.__class__
+    owner_id = getattr(item, model.meta_.hash_key.name)
+    for field in get_time_bucket_fields(model):
+        current = None if deleted else getattr(item, field.name)
+        previous = None if rebuild else item.cached_(field.name)
+        if current == previous:
+            continue
+        if previous is not None:
+            changes.deletes.append(_time_bucket_item(model, field, owner_id, previous))
+        if current is not None:
+            changes.puts.append(_time_bucket_item(model, field, owner_id, current))
+
+
+index_maintainers = [_membership_changes, _time_bucket_changes]
+""" Callables (item, deleted, changes, rebuild=False) adding the index changes a write of item needs """
+
+
+def get_changes(item, deleted=False):
+    """
+        Computes the index changes for a write of item, call it before saving,
+        syncing or deleting the item since that resets its loaded values.
+    """
+    changes = IndexChanges()
+    for maintainer in index_maintainers:
+        maintainer(item, deleted, changes)
+    return changes
+
+
+def apply_changes(engine, changes):
+    if not changes:
+        return
+    try:
+        if changes.puts:
+            engine.save(changes.puts, overwrite=True)
+        if changes.deletes:
+            engine.delete(changes.deletes)
+    except Exception as e:
+        log.error("Error updating the relation indexes {0}".format(str(e)))
+
+
+def get_owner_ids(engine, model, field_name, related_id):
+    """
+        Returns the primary keys of the model's items that have related_id in field_name
+    """
+    results = engine.query(Membership).filter(key=membership_key(model, field_name, related_id)).all(
+        attributes=['owner_id'])
+    return [result['owner_id'] for result in results]
+
+
+def get_owners(engine, model, field_name, related_id):
+    pk_name = model.meta_.hash_key.name
+    owner_ids = get_owner_ids(engine, model, field_name, related_id)
+    if not owner_ids:
+        return []
+    return engine.get(model, [{pk_name: owner_id} for owner_id in owner_ids])
+
+
+def _query_bucket(engine, bucket, lower, upper):
+    query = engine.query(TimeBucket).filter(TimeBucket.bucket == bucket)
+    if lower is not None:
+        query = query.filter(TimeBucket.ts_key >= lower)
+    if upper is not None:
+        query = query.filter(TimeBucket.ts_key < upper)
+    return [result['ts_key'].split('|', 1)[1] for result in query.all(attributes=['ts_key'])]
+
+
+def get_time_range_ids(engine, model, field_name, after=None, before=None, workers=8):
+    """
+        Returns the primary keys of the model's items with a value of field_name strictly between
+        after and before, querying every bucket of the range in parallel. An open end stops at the
+        current bucket, an open start or a range of more than max_time_buckets returns None.
+    """
+    if after is None:
+        return None
+    size = model.meta_.fields[field_name].metadata['time_bucket']
+    step = TIME_BUCKETS[size][1]
+    after = _naive_utc(after) + datetime.timedelta(microseconds=1)
+    # naive values are indexed as given, so an open range ends after both the local and the utc time
+    now = max(datetime.datetime.now(), datetime.datetime.utcnow())
+    end = _naive_utc(before) if before is not None else now + step
+    if end <= after:
+        return []
+    lower = after.strftime(TIMESTAMP_FORMAT)
+    upper = end.strftime(TIMESTAMP_FORMAT) if before is not None else None
+    buckets = []
+    current = _bucket_floor(after, size)
+    while current < end:
+        buckets.append(time_bucket_key(model, field_name, size, current))
+        if len(buckets) > max_time_buckets:
+            return None
+        current += step
+
+    def query(i):
+        # only the first and the last bucket need the range condition
+        return _query_bucket(engine, buckets[i], lower if i == 0 else None,
+                             upper if i == len(buckets) - 1 else None)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(buckets)))) as executor:
+        return [owner_id for owner_ids in executor.map(query, range(len(buckets))) for owner_id in owner_ids]
+
+
+def rebuild(engine, model):
+    """
+        Writes the index items of every existing item of model,
+        use it once after declaring a reverse index on a table that has data
+    """
+    changes = IndexChanges()
+    for item in engine.scan(model).gen():
+        for maintainer in index_maintainers:
+            maintainer(item, False, changes, rebuild=True)
+        if len(changes.puts) >= 1000:
+            apply_changes(engine, changes)
+            changes = IndexChanges()
+    apply_changes(engine, changes)
@@ -4,13 +4,15 @@ import sys
 
 import flywheel
 
-from fab_addon_flywheel import utils
+from fab_addon_flywheel import bulk, metrics, utils
+from fab_addon_flywheel.cache import ResultCache, get_item_cache, write_versions
+from fab_addon_flywheel.unit_of_work import get_unit_of_work
 from flask_appbuilder._compat import as_unicode
 from flask_appbuilder.const import LOGMSG_ERR_DBI_ADD_GENERIC, LOGMSG_ERR_DBI_DEL_GENERIC, \
     LOGMSG_ERR_DBI_EDIT_GENERIC
 from flask_appbuilder.models.base import BaseInterface
 
-from fab_addon_flywheel.models import filters
+from fab_addon_flywheel.models import filters, get_changed_fields, indexes
 from fab_addon_flywheel.utils import FlywheelQueryHelper
 
 log = logging.getLogger(__name__)
@@ -32,9 +34,40 @@ class FlywheelInterface(BaseInterface):
 
     filter_converter_class = filters.FlywheelFilterConverter
 
-    def __init__(self, obj, engine=None):
+    row_mode = False
+    """ List with compact read only rows, only when FAB asks for specific columns (select_columns) """
+
+    max_sort_items = 0
+    """ Tables up to this many (filtered) items can be ordered by any column, sorted in memory """
+
+    scan_time_budget = None
+    """ Seconds reading a list page may take, a filtered list stops early with a partial page """
+
+    scan_read_budget = None
+    """ Read units reading a list page may consume, a filtered list stops early with a partial page """
+
+    def __init__(self, obj, engine=None, read_consistency=None, read_ahead=False, row_mode=None,
+                 result_cache=None):
+        """
+            :param obj: The flywheel model class
+            :param engine: The flywheel engine
+            :param read_consistency: optional dict of read kind (list, count, relation, get)
+                to read mode ('eventual' or 'strong'), overrides the model's and the defaults
+            :param read_ahead: fetch the next list page in the background after serving one
+            :param row_mode: list with read only rows instead of models, see query_rows
+            :param result_cache: cache the results of query, a ResultCache or a dict of its options
+                like ``{'max_bytes': 4 * 1024 * 1024, 'ttl': 30}``. Writes through any interface of
+                this process invalidate it, ttl bounds how long writes of other processes go unseen.
+        """
+        if row_mode is not None:
+            self.row_mode = row_mode
+        if isinstance(result_cache, dict):
+            result_cache = ResultCache(**result_cache)
+        self.result_cache = result_cache
         self.session = engine
-        self.helper = FlywheelQueryHelper(engine, obj)
+        self.read_consistency = read_consistency
+        self.helper = FlywheelQueryHelper(engine, obj, read_consistency=read_consistency, read_ahead=read_ahead)
+        self.change_listeners = []
         _include_filters(self)
         super(FlywheelInterface, self).__init__(obj)
 
@@ -46,7 +79,68 @@ class FlywheelInterface(BaseInterface):
         """
         return self.obj.__name__
 
-    def query(self, filters=None, order_column='', order_direction='', page=None, page_size=None):
+    @metrics.instrumented('query')
+    def query(self, filters=None, order_column='', order_direction='', page=None, page_size=None,
+              select_columns=None, **kwargs):
+
+        columns = None
+        if self.row_mode and select_columns:
+            field_names = self.helper.get_field_names()
+            if all(col_name in field_names for col_name in select_columns):
+                columns = select_columns
+
+        if self.result_cache is None:
+            return self._query(columns, filters, order_column, order_direction, page, page_size)
+
+        # the version is read before querying, a write made meanwhile makes this entry unreachable
+        key = (write_versions.get(self.obj), self._filter_signature(filters), order_column, order_direction,
+               page, page_size, tuple(columns or ()))
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return self._load_result(cached)
+        result = self._query(columns, filters, order_column, order_direction, page, page_size)
+        self.result_cache.set(key, self._dump_result(result))
+        return result
+
+    @staticmethod
+    def _signature_value(value):
+        if hasattr(value, 'meta_') and hasattr(value, 'ddb_dump_'):
+            return value.meta_.name, repr(utils.get_pk_value(value))
+        return repr(value)
+
+    def _filter_signature(self, filters):
+        """
+            Filters are ANDed, so their order doesn't change the result
+        """
+        if not filters:
+            return ()
+        return tuple(sorted((flt.__class__.__name__, flt.column_name, self._signature_value(value))
+                            for flt, value in zip(filters.filters, filters.values)))
+
+    @staticmethod
+    def _dump_result(result):
+        count, items = result
+        # rows are immutable and can be shared, models are kept dumped and loaded on every hit
+        return count, [item if isinstance(item, utils.ReadOnlyRow) else item.ddb_dump_() for item in items]
+
+    def _load_result(self, cached):
+        count, items = cached
+        return count, [item if isinstance(item, utils.ReadOnlyRow) else self.obj.ddb_load_(self.session, item)
+                       for item in items]
+
+    def _query(self, columns, filters, order_column, order_direction, page, page_size):
+        desc = order_direction == 'desc'
+
+        # ordered by a sort key, a query over the index in the requested direction
+        if order_column:
+            ordered = self._get_ordered_query(filters, order_column)
+            if ordered is not None:
+                query, key_names = ordered
+                if filters:
+                    query = filters.apply_all(query)
+                return self.helper.get_list(page, page_size=page_size, query=query, columns=columns,
+                                            desc=desc, key_names=key_names, time_budget=self.scan_time_budget,
+                                            read_budget=self.scan_read_budget)
 
         # base query
         query = self.helper.get_scan()
@@ -55,8 +149,139 @@ class FlywheelInterface(BaseInterface):
         if filters:
             query = filters.apply_all(query)
 
-        return self.helper.get_list(page, page_size=page_size, sort_field=order_column, sort_desc=order_direction,
-                                    query=query)
+        if order_column and self.max_sort_items:
+            count = query.count()
+            if count <= self.max_sort_items:
+                return count, self._sorted_page(query, order_column, desc, page, page_size)
+            log.warning("Not ordering {0} by {1}, {2} items is more than max_sort_items".format(
+                self.model_name, order_column, count))
+        elif order_column:
+            # sorting a single page would look ordered while the pages are not
+            log.warning("Not ordering {0} by {1}, it has no index for it and max_sort_items is not set".format(
+                self.model_name, order_column))
+
+        return self.helper.get_list(page, page_size=page_size, query=query, columns=columns,
+                                    time_budget=self.scan_time_budget, read_budget=self.scan_read_budget)
+
+    def query_rows(self, columns, filters=None, order_column='', order_direction='', page=None, page_size=None):
+        """
+            Same as query, but returns read only rows holding only the given columns
+            (and the keys), decoded straight from the dynamo response. Use it for
+            listing and exporting, rows can't be edited or saved.
+        """
+        return self._query(columns, filters, order_column, order_direction, page, page_size)
+
+    def get_order_index(self, col_name):
+        """
+            Returns (index name, hash key name) of the table or index that has col_name as its
+            sort key, index name is None for the table itself. Returns None if there is none.
+        """
+        meta = self.obj.meta_
+        if meta.range_key is not None and meta.range_key.name == col_name:
+            return None, meta.hash_key.name
+        field = meta.fields.get(col_name)
+        if field is not None and getattr(field, 'index', None):
+            return field.index_name, meta.hash_key.name
+        for index in getattr(meta, 'global_indexes', None) or ():
+            if index.range_key == col_name:
+                return index.name, index.hash_key
+        return None
+
+    def _get_hash_value(self, filters, hash_name):
+        """
+            The value to query an index with, from an equal filter on its hash key,
+            or from the hash key's default when it is a constant (a partition for listing)
+        """
+        if filters:
+            for flt, value in zip(filters.filters, filters.values):
+                if isinstance(flt, self.FilterEqual) and flt.column_name == hash_name:
+                    return value
+        default = getattr(self.helper.get_field(hash_name), 'default', None)
+        if default is not None and not callable(default):
+            return default
+        return None
+
+    def _get_ordered_query(self, filters, order_column):
+        order_index = self.get_order_index(order_column)
+        if order_index is None:
+            return None
+        index_name, hash_name = order_index
+        hash_value = self._get_hash_value(filters, hash_name)
+        if hash_value is None:
+            return None
+        query = self.helper.get_query().filter(self.helper.get_field(hash_name) == hash_value)
+        if index_name is not None:
+            query = query.index(index_name)
+        key_names = utils.get_key_names(self.obj)
+        key_names += [name for name in (hash_name, order_column) if name not in key_names]
+        return query, key_names
+
+    def _sorted_page(self, query, order_column, desc, page, page_size):
+        items = query.all(consistent=self.helper.is_consistent('list', query=query))
+
+        def sort_key(item):
+            # None doesn't compare with values, items missing the column go last (first descending)
+            value = getattr(item, order_column)
+            return (value is None, value if value is not None else 0)
+
+        items.sort(key=sort_key, reverse=desc)
+        if page_size:
+            start = (page or 0) * page_size
+            items = items[start:start + page_size]
+        return items
+
+    aggregate_functions = {
+        'count': lambda acc, value: acc + 1,
+        'sum': lambda acc, value: acc + (value or 0),
+        'min': lambda acc, value: value if acc is None or (value is not None and value < acc) else acc,
+        'max': lambda acc, value: value if acc is None or (value is not None and value > acc) else acc,
+    }
+
+    aggregate_initial = {'count': 0, 'sum': 0, 'min': None, 'max': None}
+
+    @metrics.instrumented('aggregate')
+    def aggregate(self, group_by, aggregates, filters=None, segments=1):
+        """
+            Group by aggregation streamed from a scan that only reads the needed columns
+
+            :param group_by: column name or list of column names to group by
+            :param aggregates: list of (function, column) tuples, function is one of
+                count, sum, min or max. column is ignored by count
+            :param filters: optional FAB filters to apply
+            :param segments: number of parallel scan segments
+            :return: a list of tuples with the group values followed by the aggregated values,
+                sorted by group
+        """
+        if not isinstance(group_by, (list, tuple)):
+            group_by = [group_by]
+        for func, col_name in aggregates:
+            if func not in self.aggregate_functions:
+                raise ValueError("Unknown aggregate function {0}".format(func))
+        attributes = list(group_by)
+        for func, col_name in aggregates:
+            if col_name and func != 'count' and col_name not in attributes:
+                attributes.append(col_name)
+
+        query = self.helper.get_scan()
+        if filters:
+            query = filters.apply_all(query)
+
+        groups = {}
+        for raw in utils.parallel_scan(query, segments, attributes=attributes):
+            values = utils.load_attributes(self.obj, raw)
+            group = tuple(values.get(col_name) for col_name in group_by)
+            acc = groups.get(group)
+            if acc is None:
+                acc = [self.aggregate_initial[func] for func, col_name in aggregates]
+                groups[group] = acc
+            for i, (func, col_name) in enumerate(aggregates):
+                acc[i] = self.aggregate_functions[func](acc[i], values.get(col_name))
+
+        try:
+            keys = sorted(groups)
+        except TypeError:
+            keys = sorted(groups, key=lambda group: tuple(map(repr, group)))
+        return [group + tuple(groups[group]) for group in keys]
 
     """
     -----------------------------------------
@@ -145,9 +370,67 @@ class FlywheelInterface(BaseInterface):
     -----------------------------------------
     """
 
+    def add_change_listener(self, listener):
+        """
+            Registers a callable that gets called with this interface, the action
+            ('add', 'edit' or 'delete'), the changed items and the names of the changed fields
+            (None when unknown, for adds and deletes) after every successful add, edit, delete
+            or delete_all. Bulk actions (delete_where, update_where) don't load their items
+            and pass an empty list
+        """
+        self.change_listeners.append(listener)
+
+    def _notify_change(self, action, items, changed=None):
+        for listener in self.change_listeners:
+            listener(self, action, items, changed)
+
+    def _cache_put(self, item):
+        cache = get_item_cache(item)
+        if cache is not None:
+            cache.put(item)
+
+    def _cache_evict(self, item):
+        cache = get_item_cache(item)
+        if cache is not None:
+            cache.evict(item)
+
+    def _after_write(self, action, items, changed=None):
+        write_versions.bump(self.obj)
+        for item in items:
+            if action == 'delete':
+                self._cache_evict(item)
+            else:
+                self._cache_put(item)
+        self._notify_change(action, items, changed)
+
+    def _defer(self, action, items, index_changes):
+        """
+            Writes an add or delete through the request's unit of work, batched with its index items
+            and the writes queued before it, returns False when there is none and the caller has to
+            write itself. The unit of work is flushed here, so the view only reports success once
+            the writes are done and a failure shows as the view's error message.
+        """
+        uow = get_unit_of_work()
+        if uow is None:
+            return False
+        if action == 'delete':
+            uow.delete(*items)
+        else:
+            uow.save(*items)
+        uow.save(*index_changes.puts)
+        uow.delete(*index_changes.deletes)
+        uow.on_flush(lambda: self._after_write(action, items))
+        uow.flush()
+        return True
+
+    @metrics.instrumented('add')
     def add(self, item):
         try:
-            item.save()
+            index_changes = indexes.get_changes(item)
+            if not self._defer('add', [item], index_changes):
+                item.save()
+                indexes.apply_changes(self.session, index_changes)
+                self._after_write('add', [item])
             self.message = (as_unicode(self.add_row_message), 'success')
             return True
         except Exception as e:
@@ -155,9 +438,20 @@ class FlywheelInterface(BaseInterface):
             log.exception(LOGMSG_ERR_DBI_ADD_GENERIC.format(str(e)))
             return False
 
+    @metrics.instrumented('edit')
     def edit(self, item):
         try:
-            item.sync(raise_on_conflict=True)
+            changed = get_changed_fields(item)
+            if item.__version_field__:
+                # a conflict may save a merged item, its index changes are the ones to apply
+                attempts = []
+                item = item.sync_versioned(before_write=lambda attempt: attempts.append(indexes.get_changes(attempt)))
+                index_changes = attempts[-1]
+            else:
+                index_changes = indexes.get_changes(item)
+                item.sync(raise_on_conflict=True)
+            indexes.apply_changes(self.session, index_changes)
+            self._after_write('edit', [item], changed)
             self.message = (as_unicode(self.edit_row_message), 'success')
             return True
         except Exception as e:
@@ -165,9 +459,14 @@ class FlywheelInterface(BaseInterface):
             log.exception(LOGMSG_ERR_DBI_EDIT_GENERIC.format(str(e)))
             return False
 
+    @metrics.instrumented('delete')
     def delete(self, item):
         try:
-            item.delete()
+            index_changes = indexes.get_changes(item, deleted=True)
+            if not self._defer('delete', [item], index_changes):
+                item.delete()
+                indexes.apply_changes(self.session, index_changes)
+                self._after_write('delete', [item])
             self.message = (as_unicode(self.delete_row_message), 'success')
             return True
         except Exception as e:
@@ -175,13 +474,20 @@ class FlywheelInterface(BaseInterface):
             log.exception(LOGMSG_ERR_DBI_DEL_GENERIC.format(str(e)))
             return False
 
+    @metrics.instrumented('delete_all')
     def delete_all(self, items):
         try:
+            items = list(items)
             keys = []
+            index_changes = indexes.IndexChanges()
             for item in items:
                 pk_name = utils.get_primary_key(item)
                 keys.extend(utils.construct_keys_list(pk_name, utils.get_pk_value(item)))
-            self.session.delete(self.obj, keys)
+                index_changes.extend(indexes.get_changes(item, deleted=True))
+            if not self._defer('delete', items, index_changes):
+                self.session.delete(self.obj, keys)
+                indexes.apply_changes(self.session, index_changes)
+                self._after_write('delete', items)
 
             self.message = (as_unicode(self.delete_row_message), 'success')
             return True
@@ -191,6 +497,44 @@ class FlywheelInterface(BaseInterface):
             self.session.rollback()
             return False
 
+    def _bulk_query(self, filters):
+        query = self.helper.get_scan()
+        if filters:
+            query = filters.apply_all(query)
+        return query
+
+    @metrics.instrumented('delete_where')
+    def delete_where(self, filters=None, segments=4, workers=4, write_budget=None, progress=None):
+        """
+            Deletes every item matching filters without loading them, streaming the keys (and
+            indexed fields) from a projected scan into concurrent batch deletes
+
+            :param segments: parallel scan segments
+            :param workers: concurrent batch writers
+            :param write_budget: write units per second to consume at most, None for no limit
+            :param progress: optional callable getting the number of items of every written chunk
+            :return: the number of deleted items
+        """
+        try:
+            return bulk.bulk_delete(self.session, self.obj, self._bulk_query(filters), segments=segments,
+                                    workers=workers, write_budget=write_budget, progress=progress)
+        finally:
+            self._after_write('delete', [])
+
+    @metrics.instrumented('update_where')
+    def update_where(self, values, filters=None, segments=4, workers=4, write_budget=None, progress=None):
+        """
+            Sets values, a dict of column name to value, on every item matching filters without
+            loading them, with one UpdateItem of only those columns per item. Same options as delete_where.
+
+            :return: the number of updated items
+        """
+        try:
+            return bulk.bulk_update(self.session, self.obj, self._bulk_query(filters), values, segments=segments,
+                                    workers=workers, write_budget=write_budget, progress=progress)
+        finally:
+            self._after_write('edit', [], set(values))
+
     """
     -----------------------------------------
          FUNCTIONS FOR RELATED MODELS
@@ -210,11 +554,39 @@ class FlywheelInterface(BaseInterface):
         return self.helper.get_all(model)
 
     def get_related_interface(self, col_name):
-        return self.__class__(self.get_related_model(col_name), self.session)
+        return self.__class__(self.get_related_model(col_name), self.session, self.read_consistency)
 
+    @metrics.instrumented('get_related_obj')
     def get_related_obj(self, col_name, value):
         rel_model = self.get_related_model(col_name)
-        return self.helper.get_one(rel_model, value)
+        return self.helper.get_one(value, rel_model)
+
+    def get_reverse_ids(self, col_name, value):
+        """
+            Returns the primary keys of the items that have value in the set relation col_name,
+            or None if col_name is not declared with reverse_index=True
+        """
+        if not indexes.has_reverse_index(self.obj, col_name):
+            return None
+        return indexes.get_owner_ids(self.session, self.obj, col_name, value)
+
+    def get_reverse_related(self, col_name, value):
+        """
+            Returns the items that have value in the set relation col_name,
+            like all users with a role
+        """
+        if not indexes.has_reverse_index(self.obj, col_name):
+            return self.helper.get_scan().filter(self.helper.get_field(col_name).contains_(value)).all()
+        return indexes.get_owners(self.session, self.obj, col_name, value)
+
+    def get_time_range_ids(self, col_name, after=None, before=None):
+        """
+            Returns the primary keys of the items with a value of col_name strictly between after
+            and before, or None if col_name has no time bucket index or the range can't use it
+        """
+        if not indexes.has_time_bucket(self.obj, col_name):
+            return None
+        return indexes.get_time_range_ids(self.session, self.obj, col_name, after, before)
 
     def get_related_fks(self, related_views):
         return [view.datamodel.get_related_fk(self.obj) for view in related_views]
@@ -260,7 +632,8 @@ class FlywheelInterface(BaseInterface):
 
     def get_order_columns_list(self, list_columns=None):
         """
-            Returns the columns that can be ordered
+            Returns the columns that can be ordered, the ones that are the sort key
+            of the table or of an index, or all of them when max_sort_items is set
 
             :param list_columns: optional list of columns name, if provided will
                 use this list only.
@@ -268,7 +641,9 @@ class FlywheelInterface(BaseInterface):
         ret_lst = list()
         list_columns = list_columns or self.get_columns_list()
         for col_name in list_columns:
-            if not self.is_relation(col_name):
+            if self.is_relation(col_name):
+                continue
+            if self.max_sort_items or self.get_order_index(col_name) is not None:
                 ret_lst.append(col_name)
         return ret_lst
 
@@ -0,0 +1,151 @@
+import zlib
+
+from flywheel import Field
+from flywheel.fields.types import BinaryType
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['CompressedBinaryType', 'CompressedField', 'LazyPayload']
+
+MAGIC = b'FWC'
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+_codec_ids = {'raw': CODEC_RAW, 'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+
+def compress(data, codec='zlib', level=6):
+    """
+        Returns data prefixed with a 4 byte header (magic and codec id), compressed with codec
+    """
+    codec_id = _codec_ids[codec]
+    if codec_id == CODEC_ZLIB:
+        data = zlib.compress(data, level)
+    elif codec_id == CODEC_ZSTD:
+        if zstandard is None:
+            raise ImportError("The zstd codec needs the zstandard package")
+        data = zstandard.ZstdCompressor(level=level).compress(data)
+    return MAGIC + bytes(bytearray([codec_id])) + data
+
+
+def decompress(data):
+    """
+        Decompresses data written by compress, data without a header is returned as is
+    """
+    if data[:3] != MAGIC or len(data) < 4:
+        return data
+    codec_id = bytearray(data[3:4])[0]
+    payload = data[4:]
+    if codec_id == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    if codec_id == CODEC_ZSTD:
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed values needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return payload
+
+
+class LazyPayload(object):
+    """
+        A value loaded from a compressed attribute, it is only decompressed
+        the first time its content is used.
+    """
+    __slots__ = ('raw', '_value')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = decompress(self.raw)
+        return self._value
+
+    @property
+    def decompressed(self):
+        return self._value is not None
+
+    def __bytes__(self):
+        return self.value
+
+    def __str__(self):
+        return self.value.decode('utf-8', 'replace')
+
+    def __len__(self):
+        return len(self.value)
+
+    def __eq__(self, other):
+        # flywheel compares every loaded value with the previous one, often None, keep those cheap
+        if isinstance(other, LazyPayload):
+            return self.raw == other.raw
+        if isinstance(other, (bytes, bytearray)):
+            return self.value == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return 'LazyPayload(%d compressed bytes)' % len(self.raw)
+
+
+class CompressedBinaryType(BinaryType):
+    """
+        Binary type that stores values compressed, with a small header.
+
+        Values shorter than threshold are stored uncompressed (with the header),
+        values loaded from dynamo are only decompressed when first used, and
+        values that were never decompressed are written back as they were read.
+
+        :param codec: 'zlib' or 'zstd' (needs the zstandard package)
+        :param level: compression level
+        :param threshold: minimum size in bytes to compress a value
+    """
+    def __init__(self, codec='zlib', level=6, threshold=256):
+        super(CompressedBinaryType, self).__init__()
+        if codec not in _codec_ids:
+            raise ValueError("Unknown codec {0}".format(codec))
+        self.codec = codec
+        self.level = level
+        self.threshold = threshold
+
+    def coerce(self, value, force):
+        if isinstance(value, LazyPayload):
+            return value
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        return super(CompressedBinaryType, self).coerce(value, force)
+
+    def ddb_dump(self, value):
+        if isinstance(value, LazyPayload):
+            data = value.raw
+        else:
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+            codec = self.codec if len(value) >= self.threshold else 'raw'
+            data = compress(value, codec, self.level)
+        return super(CompressedBinaryType, self).ddb_dump(data)
+
+    def ddb_load(self, value):
+        return LazyPayload(super(CompressedBinaryType, self).ddb_load(value))
+
+
+def CompressedField(codec='zlib', level=6, threshold=256, **kwargs):
+    """
+        Returns a flywheel Field that stores its value compressed, for large text or JSON
+        payloads. It is still seen as a text column by FlywheelInterface.is_text.
+
+            description = CompressedField(codec='zlib', threshold=512)
+    """
+    return Field(type=CompressedBinaryType(codec, level, threshold), **kwargs)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+def _field_schema(field):
+    if field is None:
+        return None
+    return [field.name, field.ddb_data_type]
+
+
+def model_schema(engine, model):
+    """
+        A json serializable description of everything that makes a model's table
+    """
+    meta = model.meta_
+    return {
+        'table': meta.ddb_tablename(engine.namespace),
+        'hash_key': _field_schema(meta.hash_key),
+        'range_key': _field_schema(meta.range_key),
+        'indexes': sorted([field.name, field.index_name] for field in meta.fields.values()
+                          if getattr(field, 'index', None)),
+        'global_indexes': sorted([index.name, index.hash_key, index.range_key]
+                                 for index in getattr(meta, 'global_indexes', None) or ()),
+        'throughput': repr(meta.__dict__.get('throughput')),
+    }
+
+
+def schema_fingerprint(engine, models):
+    schemas = sorted((model_schema(engine, model) for model in models), key=lambda schema: schema['table'])
+    data = json.dumps([repr(engine.namespace), getattr(engine.dynamo, 'region', None), schemas], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def default_cache_path(engine):
+    name = hashlib.sha1(repr(engine.namespace).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), 'fab_flywheel_schema_{0}'.format(name))
+
+
+def _read_cache(path, ttl):
+    try:
+        if ttl and time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _write_cache(path, fingerprint):
+    tmp_path = '{0}.{1}'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(fingerprint)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        log.warning("Could not write the schema cache {0}: {1}".format(path, str(e)))
+
+
+def _is_active(table):
+    if table is None or table.status != 'ACTIVE':
+        return False
+    return all(index.status == 'ACTIVE' for index in getattr(table, 'global_indexes', None) or ())
+
+
+def _wait_active(engine, tablename, timeout, interval=0.5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if _is_active(engine.dynamo.describe_table(tablename)):
+            return
+        time.sleep(interval)
+    raise RuntimeError("Table {0} is not active after {1}s".format(tablename, timeout))
+
+
+def reconcile_schema(engine, models=None, cache_path=None, cache_ttl=3600, workers=8, timeout=300):
+    """
+        Makes sure the tables of models exist and are active, faster than engine.create_schema:
+        tables are described, created and waited on concurrently, and a fingerprint of the schema
+        is cached in a local file so workers booting with an unchanged schema skip it entirely.
+
+        :param models: models to reconcile, defaults to all the engine's models
+        :param cache_path: fingerprint file, defaults to a file in the temp directory, False disables it
+        :param cache_ttl: seconds the fingerprint is trusted
+        :return: dict with the time spent in every step and the created tables
+    """
+    models = list(models if models is not None else engine.models.values())
+    timings = {'skipped': False, 'created': []}
+    start = time.time()
+    fingerprint = schema_fingerprint(engine, models)
+    if cache_path is None:
+        cache_path = default_cache_path(engine)
+    if cache_path and _read_cache(cache_path, cache_ttl) == fingerprint:
+        timings['skipped'] = True
+        timings['total'] = time.time() - start
+        return timings
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(models)))) as executor:
+        step = time.time()
+        tablenames = [model.meta_.ddb_tablename(engine.namespace) for model in models]
+        tables = dict(zip(tablenames, executor.map(engine.dynamo.describe_table, tablenames)))
+        timings['describe'] = time.time() - step
+
+        step = time.time()
+        existing = set(name for name, table in tables.items() if table is not None)
+        missing = [model for model, name in zip(models, tablenames) if name not in existing]
+        list(executor.map(lambda model: model.meta_.create_dynamo_schema(
+            engine.dynamo, tablenames=existing, wait=False, namespace=engine.namespace), missing))
+        timings['created'] = [model.meta_.name for model in missing]
+        timings['create'] = time.time() - step
+
+        step = time.time()
+        pending = [name for name in tablenames if not _is_active(tables.get(name))]
+        list(executor.map(lambda name: _wait_active(engine, name, timeout), pending))
+        timings['wait'] = time.time() - step
+
+    if cache_path:
+        _write_cache(cache_path, fingerprint)
+    timings['total'] = time.time() - start
+    return timings
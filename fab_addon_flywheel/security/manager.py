@@ -1,13 +1,24 @@
 import logging
+import threading
+import time
 import uuid
 
 from flask_appbuilder import const as c
 from flask_appbuilder.security.manager import BaseSecurityManager
 from werkzeug.security import generate_password_hash
 
+from fab_addon_flywheel import metrics
+from fab_addon_flywheel.cache import configure_item_cache, copy_items, get_item_cache, single_flight, \
+    write_versions
+from fab_addon_flywheel.models import indexes
 from fab_addon_flywheel.models.interface import FlywheelInterface
-from fab_addon_flywheel.utils import get_pk_value
-from .models import Permission, PermissionView, RegisterUser, Role, User, ViewMenu
+from fab_addon_flywheel.schema import reconcile_schema
+from fab_addon_flywheel.unit_of_work import UnitOfWork
+from fab_addon_flywheel.utils import is_consistent
+from fab_addon_flywheel.warmup import warm_model
+from .snapshot import SnapshotFile
+from .models import Permission, PermissionView, RegisterUser, Role, SecurityVersion, User, ViewMenu, \
+    permission_view_name
 
 log = logging.getLogger(__name__)
 
@@ -28,6 +39,13 @@ class SecurityManager(BaseSecurityManager):
     viewmenu_model = ViewMenu
     permissionview_model = PermissionView
     registeruser_model = RegisterUser
+    securityversion_model = SecurityVersion
+
+    security_version_id = 'security'
+    """ Primary key of the security version item """
+
+    user_security_fields = frozenset(['role_ids', 'active'])
+    """ User fields whose changes bump the security version """
 
     generate_password_hash = generate_password_hash
 
@@ -38,6 +56,21 @@ class SecurityManager(BaseSecurityManager):
                 F.A.B AppBuilder main object
         """
         super(SecurityManager, self).__init__(appbuilder)
+        self.security_version_ttl = appbuilder.get_app.config.get('FLYWHEEL_SECURITY_VERSION_TTL', 5)
+        self._security_version = None
+        self._security_version_checked = 0
+        self._security_version_item = None
+        self._security_version_lock = threading.Lock()
+        self._security_cache_clearers = []
+        snapshot_path = appbuilder.get_app.config.get('FLYWHEEL_SECURITY_SNAPSHOT')
+        self.security_snapshot = SnapshotFile(snapshot_path) if snapshot_path else None
+        appbuilder.get_app.before_request(self.check_security_version)
+
+        cache_options = appbuilder.get_app.config.get('FLYWHEEL_SECURITY_CACHE')
+        if cache_options is not None:
+            for model in (self.role_model, self.permission_model, self.viewmenu_model, self.permissionview_model):
+                configure_item_cache(model, **cache_options)
+
         user_datamodel = FlywheelInterface(self.user_model, appbuilder.get_session)
         if self.auth_type == c.AUTH_DB:
             self.userdbmodelview.datamodel = user_datamodel
@@ -59,6 +92,10 @@ class SecurityManager(BaseSecurityManager):
         self.viewmenumodelview.datamodel = FlywheelInterface(self.viewmenu_model, appbuilder.get_session)
         self.permissionviewmodelview.datamodel = FlywheelInterface(self.permissionview_model, appbuilder.get_session)
 
+        for datamodel in (user_datamodel, self.rolemodelview.datamodel, self.permissionmodelview.datamodel,
+                          self.viewmenumodelview.datamodel, self.permissionviewmodelview.datamodel):
+            datamodel.add_change_listener(self._on_security_change)
+
         self.create_db()
 
     @property
@@ -68,11 +105,132 @@ class SecurityManager(BaseSecurityManager):
     def register_views(self):
         super(SecurityManager, self).register_views()
 
+    """
+        ----------------------------------------
+            SECURITY VERSION
+        ----------------------------------------
+    """
+    def register_security_cache(self, clear):
+        """
+            Registers a callable that drops a local cache of security data,
+            it gets called whenever another worker changed roles, permissions or users
+
+            :param clear: callable without arguments
+        """
+        self._security_cache_clearers.append(clear)
+
+    def _security_models(self):
+        return (self.user_model, self.role_model, self.permission_model,
+                self.viewmenu_model, self.permissionview_model)
+
+    def clear_security_caches(self):
+        write_versions.bump(*self._security_models())
+        for model in self._security_models():
+            cache = get_item_cache(model)
+            if cache is not None:
+                cache.clear()
+        for clear in self._security_cache_clearers:
+            clear()
+
+    def _set_security_version(self, version):
+        if self._security_version is not None and version != self._security_version:
+            log.debug("Security version changed from {0} to {1}".format(self._security_version, version))
+            self.clear_security_caches()
+        self._security_version = version
+        self._security_version_checked = time.time()
+
+    def get_security_version(self):
+        item = self.engine.get(self.securityversion_model, id=self.security_version_id, consistent=True)
+        return item.version if item is not None else 0
+
+    def check_security_version(self, force=False):
+        """
+            Reads the security version at most once every FLYWHEEL_SECURITY_VERSION_TTL seconds
+            and drops the local caches if some worker changed it.
+        """
+        if not force and time.time() - self._security_version_checked < self.security_version_ttl:
+            return
+        try:
+            self._set_security_version(self.get_security_version())
+        except Exception as e:
+            log.error("Error reading the security version {0}".format(str(e)))
+
+    def bump_security_version(self):
+        """
+            Atomically increments the security version so every worker drops its caches
+        """
+        try:
+            with self._security_version_lock:
+                stamp = self._security_version_item
+                if stamp is None:
+                    stamp = self.engine.get(self.securityversion_model, id=self.security_version_id)
+                    if stamp is None:
+                        stamp = self.securityversion_model(id=self.security_version_id, version=0)
+                        try:
+                            self.engine.save(stamp)
+                        except Exception:
+                            stamp = self.engine.get(self.securityversion_model, id=self.security_version_id,
+                                                    consistent=True)
+                    self._security_version_item = stamp
+                previous = self._security_version
+                stamp.incr_(version=1)
+                self.engine.sync(stamp)
+            if previous is not None and stamp.version != previous + 1:
+                # someone else changed it since we last looked
+                self.clear_security_caches()
+            self._security_version = stamp.version
+            self._security_version_checked = time.time()
+            # cached list results of the security views are stale too
+            write_versions.bump(*self._security_models())
+        except Exception as e:
+            log.error("Error updating the security version {0}".format(str(e)))
+
+    def _on_security_change(self, datamodel, action, items, changed=None):
+        if action != 'delete' and datamodel.obj is self.role_model:
+            for role in items:
+                self.sync_role_permission_names(role)
+        if (datamodel.obj is self.user_model and action == 'edit' and changed is not None and
+                not changed & self.user_security_fields):
+            # a name or email edit doesn't change any access, only the user lists are stale
+            write_versions.bump(self.user_model)
+            return
+        self.bump_security_version()
+
+    def _find_by_name(self, model, name):
+        cache = get_item_cache(model)
+        if cache is not None:
+            item = cache.get_by(self.engine, 'name', name)
+            if item is not None:
+                return item
+        query = self.engine.scan(model).filter(name=name)
+        consistent = is_consistent('auth', model, query=query)
+        item = single_flight.do(
+            ('name', model.meta_.name, name, consistent),
+            lambda: query.first(consistent=consistent),
+            self._copy_items)
+        if cache is not None and item is not None:
+            cache.put(item, 'name')
+        return item
+
+    def _copy_items(self, result):
+        return copy_items(self.engine, result)
+
+    def _cache_put(self, item):
+        cache = get_item_cache(item)
+        if cache is not None:
+            cache.put(item)
+
+    def _cache_evict(self, item):
+        cache = get_item_cache(item)
+        if cache is not None:
+            cache.evict(item)
+
     def create_db(self):
         try:
             models = [
                 self.user_model, self.role_model, self.permission_model, self.viewmenu_model,
-                self.permissionview_model, self.registeruser_model
+                self.permissionview_model, self.registeruser_model, self.securityversion_model,
+                indexes.Membership, indexes.TimeBucket
             ]
 
             models_to_register = []
@@ -81,18 +239,30 @@ class SecurityManager(BaseSecurityManager):
                     models_to_register.append(model)
 
             if models_to_register:
-                log.info(c.LOGMSG_INF_SEC_NO_DB)
                 self.engine.register(*models_to_register)
-                self.engine.create_schema()
+
+            config = self.appbuilder.get_app.config
+            timings = reconcile_schema(self.engine, cache_path=config.get('FLYWHEEL_SCHEMA_CACHE'),
+                                       cache_ttl=config.get('FLYWHEEL_SCHEMA_CACHE_TTL', 3600))
+            if timings['created']:
                 log.info(c.LOGMSG_INF_SEC_ADD_DB)
+
+            step = time.time()
             super(SecurityManager, self).create_db()
+            self.backfill_role_permission_names()
+            timings['security'] = time.time() - step
+            log.info("Flywheel boot: {0}".format(', '.join(
+                '{0}={1:.3f}s'.format(key, value) for key, value in sorted(timings.items())
+                if isinstance(value, float))))
         except Exception as e:
             log.error(c.LOGMSG_ERR_SEC_CREATE_DB.format(str(e)))
             exit(1)
 
+    @metrics.instrumented('find_register_user', 'registeruser_model')
     def find_register_user(self, registration_hash):
-        return self.engine.scan(self.registeruser_model).filter(
-            self.registeruser_model.registration_hash == registration_hash).one()
+        query = self.engine.scan(self.registeruser_model).filter(
+            self.registeruser_model.registration_hash == registration_hash)
+        return query.one(consistent=is_consistent('auth', self.registeruser_model, query=query))
 
     def add_register_user(self, username, first_name, last_name, email,
                           password='', hashed_password=''):
@@ -112,7 +282,9 @@ class SecurityManager(BaseSecurityManager):
             register_user.password = self.generate_password_hash(password)
         register_user.registration_hash = str(uuid.uuid1())
         try:
+            index_changes = indexes.get_changes(register_user)
             self.engine.save(register_user, overwrite=True)
+            indexes.apply_changes(self.engine, index_changes)
             register_user.__engine__ = self.engine
             return register_user
         except Exception as e:
@@ -126,23 +298,37 @@ class SecurityManager(BaseSecurityManager):
             :param register_user: RegisterUser object to delete
         """
         try:
+            index_changes = indexes.get_changes(register_user, deleted=True)
             register_user.delete(raise_on_conflict=True)
+            indexes.apply_changes(self.engine, index_changes)
             return True
         except Exception as e:
             log.error(c.LOGMSG_ERR_SEC_DEL_REGISTER_USER.format(str(e)))
             return False
 
+    @metrics.instrumented('find_user', 'user_model')
     def find_user(self, username=None, email=None):
         """
             Finds user by username or email
         """
         if username:
-            return self.engine.scan(self.user_model).filter(self.user_model.username == username).first()
+            query = self.engine.scan(self.user_model).filter(self.user_model.username == username)
+            consistent = is_consistent('auth', self.user_model, query=query)
+            return single_flight.do(
+                ('username', self.user_model.meta_.name, username, consistent),
+                lambda: query.first(consistent=consistent),
+                self._copy_items)
         elif email:
-            return self.engine.scan(self.user_model).filter(email=email).first()
+            query = self.engine.scan(self.user_model).filter(email=email)
+            consistent = is_consistent('auth', self.user_model, query=query)
+            return single_flight.do(
+                ('email', self.user_model.meta_.name, email, consistent),
+                lambda: query.first(consistent=consistent),
+                self._copy_items)
 
     def get_all_users(self):
-        return self.engine.scan(self.user_model).all()
+        query = self.engine.scan(self.user_model)
+        return query.all(consistent=is_consistent('list', self.user_model, query=query))
 
     def add_user(self, username, first_name, last_name, email, role, password='', hashed_password='', **kwargs):
         """
@@ -155,14 +341,17 @@ class SecurityManager(BaseSecurityManager):
             user.username = username
             user.email = email
             user.active = True
-            user.roles.append(role)
+            user.role_ids = set([role.id])
             if hashed_password:
                 user.password = hashed_password
             else:
                 user.password = generate_password_hash(password)
 
-            self.engine.save(user)
-            user.__engine__ = self.engine
+            # the user and its relation index items in one batch
+            batch = UnitOfWork(self.engine)
+            batch.save(user, *indexes.get_changes(user).puts)
+            batch.flush()
+            self.bump_security_version()
             log.info(c.LOGMSG_INF_SEC_ADD_USER.format(username))
             return user
         except Exception as e:
@@ -174,14 +363,37 @@ class SecurityManager(BaseSecurityManager):
 
     def update_user(self, user):
         try:
-            user.sync(raise_on_conflict=True)
+            # logins update the user too, only role and active changes concern the other workers
+            security_changed = self.is_security_change(user)
+            if user.__version_field__:
+                # a conflict may save a merged user, its index changes are the ones to apply
+                attempts = []
+                user = user.sync_versioned(before_write=lambda attempt: attempts.append(indexes.get_changes(attempt)))
+                index_changes = attempts[-1]
+            else:
+                index_changes = indexes.get_changes(user)
+                user.sync(raise_on_conflict=True)
+            indexes.apply_changes(self.engine, index_changes)
+            if security_changed:
+                self.bump_security_version()
+            else:
+                write_versions.bump(self.user_model)
             log.info(c.LOGMSG_INF_SEC_UPD_USER.format(user))
+            return user
         except Exception as e:
             log.error(c.LOGMSG_ERR_SEC_UPD_USER.format(str(e)))
             return False
 
+    def is_security_change(self, user):
+        """
+            True if a pending write of user changes what it may access, its roles or its active flag
+        """
+        return any(getattr(user, name) != user.cached_(name) for name in self.user_security_fields)
+
+    @metrics.instrumented('get_user_by_id', 'user_model')
     def get_user_by_id(self, pk):
-        return self.engine.scan(self.user_model).filter(get_pk_value(self.user_model) == pk).one()
+        pk_name = self.user_model.meta_.hash_key.name
+        return self.engine.get(self.user_model, consistent=is_consistent('auth', self.user_model), **{pk_name: pk})
 
     """
         ----------------------------------------
@@ -196,27 +408,168 @@ class SecurityManager(BaseSecurityManager):
                 role.name = name
                 self.engine.save(role)
                 role.__engine__ = self.engine
+                self._cache_put(role)
+                self.bump_security_version()
                 log.info(c.LOGMSG_INF_SEC_ADD_ROLE.format(name))
                 return role
             except Exception as e:
                 log.error(c.LOGMSG_ERR_SEC_ADD_ROLE.format(str(e)))
         return role
 
+    @metrics.instrumented('find_role', 'role_model')
     def find_role(self, name):
-        return self.engine.scan(self.role_model).filter(name=name).first()
+        return self._find_by_name(self.role_model, name)
 
     def get_all_roles(self):
-        return self.engine.scan(self.role_model).all()
+        query = self.engine.scan(self.role_model)
+        return query.all(consistent=is_consistent('list', self.role_model, query=query))
+
+    def warm_up(self, budget=None):
+        """
+            Loads the roles, permissions, view menus and permission views into their item caches, if
+            FLYWHEEL_SECURITY_CACHE enabled them, returns the number of items loaded. Called at boot
+            by the FLYWHEEL_WARMUP background thread.
+        """
+        count = 0
+        for model in (self.role_model, self.permission_model, self.viewmenu_model, self.permissionview_model):
+            if get_item_cache(model) is None:
+                continue
+            lookup_fields = ('name',) if 'name' in model.meta_.fields else ()
+            count += warm_model(self.engine, model, budget, lookup_fields)
+        self.find_role(self.auth_role_public)
+        return count
 
     def get_public_permissions(self):
-        role = self.engine.scan(self.role_model).filter(name=self.auth_role_public).first()
+        role = self.find_role(self.auth_role_public)
         return role.permissions
 
+    @metrics.instrumented('get_roles_by_id', 'role_model')
+    def get_roles_by_id(self, role_ids):
+        """
+            Returns the roles with the given ids with a single batch get,
+            roles found in the item cache are not read again
+        """
+        roles, missing = [], list(role_ids or ())
+        cache = get_item_cache(self.role_model)
+        if cache is not None:
+            roles, missing = cache.get_many(self.engine, missing)
+        if missing:
+            consistent = is_consistent('auth', self.role_model)
+            fetched = single_flight.do(
+                ('get', self.role_model.meta_.name, tuple(sorted(missing)), consistent),
+                lambda: self.engine.get(self.role_model, [{'id': role_id} for role_id in missing],
+                                        consistent=consistent),
+                self._copy_items)
+            if cache is not None:
+                for role in fetched:
+                    cache.put(role)
+            roles.extend(fetched)
+        return roles
+
+    def _read_security_snapshot(self):
+        roles = [(role.id, role.name, self.get_role_permission_names(role)) for role in self.get_all_roles()]
+        pk_name = self.user_model.meta_.hash_key.name
+        query = self.engine.scan(self.user_model)
+        users = [(user[pk_name], user.get('role_ids')) for user in query.all(
+            attributes=[pk_name, 'role_ids'], consistent=is_consistent('list', self.user_model, query=query))]
+        return roles, users
+
+    def get_security_snapshot(self):
+        """
+            Returns the host wide snapshot of the roles' permissions and the users' roles for the
+            current security version, or None if FLYWHEEL_SECURITY_SNAPSHOT is not set
+        """
+        if self.security_snapshot is None:
+            return None
+        if self._security_version is None:
+            self.check_security_version(force=True)
+        try:
+            return self.security_snapshot.get(self._security_version or 0, self._read_security_snapshot)
+        except Exception as e:
+            log.error("Error loading the security snapshot {0}".format(str(e)))
+            return None
+
+    def get_user_permission_names(self, user):
+        """
+            Returns the set of 'permission|view_menu' names the user's roles allow
+        """
+        names = set()
+        for role in self.get_roles_by_id(user.role_ids):
+            names.update(self.get_role_permission_names(role))
+        return names
+
+    def _has_view_access(self, user, permission_name, view_name):
+        snapshot = self.get_security_snapshot()
+        if snapshot is not None:
+            role_ids = user.role_ids
+            if role_ids is None:
+                role_ids = snapshot.user_role_ids(user.id)
+            return snapshot.has_access(role_ids, permission_view_name(permission_name, view_name))
+        return permission_view_name(permission_name, view_name) in self.get_user_permission_names(user)
+
+    def is_item_public(self, permission_name, view_name):
+        snapshot = self.get_security_snapshot()
+        if snapshot is not None:
+            role_id = snapshot.role_id(self.auth_role_public)
+            return role_id is not None and snapshot.role_has(role_id, permission_view_name(permission_name,
+                                                                                            view_name))
+        role = self.find_role(self.auth_role_public)
+        if role is None:
+            return False
+        return permission_view_name(permission_name, view_name) in self.get_role_permission_names(role)
+
+    def get_role_permission_names(self, role):
+        """
+            Returns the materialized permission names of a role, computing and saving
+            them first for roles written before they existed
+        """
+        if role.permission_ids and not role.permission_names:
+            return self.sync_role_permission_names(role)
+        return role.permission_names or set()
+
+    def sync_role_permission_names(self, role):
+        """
+            Recomputes the materialized permission names of a role from its permission ids,
+            and saves them if they changed
+        """
+        role.__engine__ = self.engine
+        names = set(pv.name for pv in role.permissions)
+        if names != set(role.permission_names or ()):
+            try:
+                role.permission_names = names
+                self.engine.sync(role)
+                self._cache_put(role)
+            except Exception as e:
+                log.error(c.LOGMSG_ERR_SEC_ADD_PERMROLE.format(str(e)))
+        return names
+
+    def rebuild_role_permission_names(self):
+        """
+            Recomputes the materialized permission names of every role,
+            use it once on tables created before permission names existed
+        """
+        for role in self.get_all_roles():
+            self.sync_role_permission_names(role)
+        self.bump_security_version()
+
+    def backfill_role_permission_names(self):
+        """
+            Computes the materialized permission names of the roles that have permissions
+            but no names yet, called by create_db so upgraded tables need no manual step
+        """
+        roles = [role for role in self.get_all_roles() if role.permission_ids and not role.permission_names]
+        for role in roles:
+            self.sync_role_permission_names(role)
+        if roles:
+            log.info("Backfilled the permission names of {0} roles".format(len(roles)))
+            self.bump_security_version()
+
+    @metrics.instrumented('find_permission', 'permission_model')
     def find_permission(self, name):
         """
             Finds and returns a Permission by name
         """
-        return self.engine.scan(self.permission_model).filter(name=name).first()
+        return self._find_by_name(self.permission_model, name)
 
     def add_permission(self, name):
         """
@@ -232,6 +585,8 @@ class SecurityManager(BaseSecurityManager):
                 perm.name = name
                 self.engine.save(perm)
                 perm.__engine__ = self.engine
+                self._cache_put(perm)
+                self.bump_security_version()
                 return perm
             except Exception as e:
                 log.error(c.LOGMSG_ERR_SEC_ADD_PERMISSION.format(str(e)))
@@ -248,20 +603,24 @@ class SecurityManager(BaseSecurityManager):
         if perm:
             try:
                 self.engine.delete(perm)
+                self._cache_evict(perm)
+                self.bump_security_version()
             except Exception as e:
                 log.error(c.LOGMSG_ERR_SEC_DEL_PERMISSION.format(str(e)))
 
     # ----------------------------------------------
     #       PRIMITIVES VIEW MENU
     # ----------------------------------------------
+    @metrics.instrumented('find_view_menu', 'viewmenu_model')
     def find_view_menu(self, name):
         """
             Finds and returns a ViewMenu by name
         """
-        return self.engine.scan(self.viewmenu_model).filter(name=name).first()
+        return self._find_by_name(self.viewmenu_model, name)
 
     def get_all_view_menu(self):
-        return self.engine.scan(self.viewmenu_model).all()
+        query = self.engine.scan(self.viewmenu_model)
+        return query.all(consistent=is_consistent('list', self.viewmenu_model, query=query))
 
     def add_view_menu(self, name):
         """
@@ -276,6 +635,8 @@ class SecurityManager(BaseSecurityManager):
                 view_menu.name = name
                 self.engine.save(view_menu)
                 view_menu.__engine__ = self.engine
+                self._cache_put(view_menu)
+                self.bump_security_version()
                 return view_menu
             except Exception as e:
                 log.error(c.LOGMSG_ERR_SEC_ADD_VIEWMENU.format(str(e)))
@@ -292,20 +653,28 @@ class SecurityManager(BaseSecurityManager):
         if obj:
             try:
                 self.engine.delete(obj)
+                self._cache_evict(obj)
+                self.bump_security_version()
             except Exception as e:
                 log.error(c.LOGMSG_ERR_SEC_DEL_PERMISSION.format(str(e)))
 
     # ----------------------------------------------
     #          PERMISSION VIEW MENU
     # ----------------------------------------------
+    @metrics.instrumented('find_permission_view_menu', 'permissionview_model')
     def find_permission_view_menu(self, permission_name, view_menu_name):
         """
             Finds and returns a PermissionView by names
         """
         permission = self.find_permission(permission_name)
         view_menu = self.find_view_menu(view_menu_name)
-        return self.engine.scan(self.permissionview_model).filter(permission=permission, view_menu=view_menu).first()
+        if permission is None or view_menu is None:
+            return None
+        query = self.engine.scan(self.permissionview_model).filter(
+            permission_id=permission.id, view_menu_id=view_menu.id)
+        return query.first(consistent=is_consistent('auth', self.permissionview_model, query=query))
 
+    @metrics.instrumented('find_permissions_view_menu', 'permissionview_model')
     def find_permissions_view_menu(self, view_menu):
         """
             Finds all permissions from ViewMenu, returns list of PermissionView
@@ -313,7 +682,8 @@ class SecurityManager(BaseSecurityManager):
             :param view_menu: ViewMenu object
             :return: list of PermissionView objects
         """
-        return self.engine.scan(self.permissionview_model).filter(view_menu_id=view_menu.id).all()
+        query = self.engine.scan(self.permissionview_model).filter(view_menu_id=view_menu.id)
+        return query.all(consistent=is_consistent('auth', self.permissionview_model, query=query))
 
     def add_permission_view_menu(self, permission_name, view_menu_name):
         """
@@ -324,13 +694,26 @@ class SecurityManager(BaseSecurityManager):
             :param view_menu_name:
                 name of the view menu to add
         """
-        vm = self.add_view_menu(view_menu_name)
-        perm = self.add_permission(permission_name)
+        # the missing view menu and permission are written with the permission view in one batch
+        batch = UnitOfWork(self.engine)
+        vm = self.find_view_menu(view_menu_name)
+        if vm is None:
+            vm = self.viewmenu_model()
+            vm.name = view_menu_name
+            batch.save(vm)
+        perm = self.find_permission(permission_name)
+        if perm is None:
+            perm = self.permission_model()
+            perm.name = permission_name
+            batch.save(perm)
         pv = self.permissionview_model()
         pv.view_menu_id, pv.permission_id = vm.id, perm.id
+        batch.save(pv)
         try:
-            self.engine.save(pv)
-            pv.__engine__ = self.engine
+            batch.flush()
+            for item in (vm, perm, pv):
+                self._cache_put(item)
+            self.bump_security_version()
             log.info(c.LOGMSG_INF_SEC_ADD_PERMVIEW.format(str(pv)))
             return pv
         except Exception as e:
@@ -339,12 +722,18 @@ class SecurityManager(BaseSecurityManager):
     def del_permission_view_menu(self, permission_name, view_menu_name):
         try:
             pv = self.find_permission_view_menu(permission_name, view_menu_name)
+            # remove it from the roles that have it
+            roles = indexes.get_owners(self.engine, self.role_model, 'permission_ids', pv.id)
+            for role in roles:
+                self.del_permission_role(role, pv)
             # delete permission on view
             self.engine.delete(pv)
+            self._cache_evict(pv)
+            self.bump_security_version()
             # if no more permission on permission view, delete permission
-            pv = self.engine.scan(self.permissionview_model).filter(permission=pv.permission).all()
-            if not pv:
-                self.del_permission(pv.permission.name)
+            others = self.engine.scan(self.permissionview_model).filter(permission_id=pv.permission_id).all()
+            if not others:
+                self.del_permission(permission_name)
             log.info(c.LOGMSG_INF_SEC_DEL_PERMVIEW.format(permission_name, view_menu_name))
         except Exception as e:
             log.error(c.LOGMSG_ERR_SEC_DEL_PERMVIEW.format(str(e)))
@@ -370,11 +759,15 @@ class SecurityManager(BaseSecurityManager):
             :param perm_view:
                 The PermissionViewMenu object
         """
-        if perm_view not in role.permissions:
+        if perm_view.id not in (role.permission_ids or ()):
             try:
-                role.permissions.append(perm_view)
+                role.add_(permission_ids=perm_view.id, permission_names=perm_view.name)
                 self.engine.sync(role)
+                indexes.apply_changes(self.engine, indexes.membership_changes(
+                    self.role_model, 'permission_ids', role.id, added=[perm_view.id]))
                 role.__engine__ = self.engine
+                self._cache_put(role)
+                self.bump_security_version()
                 log.info(c.LOGMSG_INF_SEC_ADD_PERMROLE.format(str(perm_view), role.name))
             except Exception as e:
                 log.error(c.LOGMSG_ERR_SEC_ADD_PERMROLE.format(str(e)))
@@ -388,10 +781,14 @@ class SecurityManager(BaseSecurityManager):
             :param perm_view:
                 The PermissionViewMenu object
         """
-        if perm_view in role.permissions:
+        if perm_view.id in (role.permission_ids or ()):
             try:
-                role.permissions.remove(perm_view)
+                role.remove_(permission_ids=perm_view.id, permission_names=perm_view.name)
                 self.engine.sync(role)
+                indexes.apply_changes(self.engine, indexes.membership_changes(
+                    self.role_model, 'permission_ids', role.id, removed=[perm_view.id]))
+                self._cache_put(role)
+                self.bump_security_version()
                 log.info(c.LOGMSG_INF_SEC_DEL_PERMROLE.format(str(perm_view), role.name))
             except Exception as e:
                 log.error(c.LOGMSG_ERR_SEC_DEL_PERMROLE.format(str(e)))
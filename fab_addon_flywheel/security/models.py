@@ -19,6 +19,10 @@ def get_user():
     return g.user.id
 
 
+def permission_view_name(permission_name, view_menu_name):
+    return u'{0}|{1}'.format(permission_name, view_menu_name)
+
+
 class Permission(Model):
     id = Field(type=str, default=gen_id, hash_key=True)
     name = Field(type=str, nullable=False)
@@ -62,6 +66,10 @@ class PermissionView(Model):
     def view_menu(self, value):
         self.set_related_models("view_menu_id", value)
 
+    @property
+    def name(self):
+        return permission_view_name(self.permission.name, self.view_menu.name)
+
     def __repr__(self):
         return str(self.permission).replace('_', ' ') + ' on ' + str(self.view_menu)
 
@@ -69,7 +77,9 @@ class PermissionView(Model):
 class Role(Model):
     id = Field(type=str, default=gen_id, hash_key=True)
     name = Field(type=str, nullable=False)
-    permission_ids = Field(type=set_(str), model='Permission')
+    permission_ids = Field(type=set_(str), model='PermissionView', reverse_index=True)
+    permission_names = Field(type=set_(str))
+    """ Materialized 'permission|view_menu' names of permission_ids """
 
     @property
     def permissions(self):
@@ -96,7 +106,7 @@ class User(Model):
     fail_login_count = Field(type=int)
     created_on = Field(type=datetime.datetime, default=datetime.datetime.now, nullable=True)
     changed_on = Field(type=datetime.datetime, default=datetime.datetime.now, nullable=True)
-    role_ids = Field(type=set_(str), model="Role")
+    role_ids = Field(type=set_(str), model="Role", reverse_index=True)
     created_by_id = Field(type=str, default=get_user, nullable=True, model="User")
     changed_by_id = Field(type=str, default=get_user, nullable=True, model="User")
 
@@ -152,3 +162,12 @@ class RegisterUser(Model):
     email = Field(type=str, nullable=False)
     registration_date = Field(type=datetime.datetime, default=datetime.datetime.now, nullable=True)
     registration_hash = Field(type=str)
+
+
+class SecurityVersion(Model):
+    """
+        A single item bumped on every role, permission or user change,
+        used by every worker to know when its local caches are stale
+    """
+    id = Field(type=str, hash_key=True)
+    version = Field(type=int, default=0)
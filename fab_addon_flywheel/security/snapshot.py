@@ -0,0 +1,244 @@
+"""
+    Immutable binary snapshot of the resolved security data, shared by every worker of a host.
+
+    One worker builds it from the tables and replaces the file atomically, the others memory map it,
+    so lookups read straight from the page cache and the data is held once per host.
+
+    Layout, all integers little endian::
+
+        header   magic 'FWSS', format (H), reserved (H), security version (Q),
+                 string count (I), role count (I), user count (I)
+        strings  string count + 1 offsets (I) into the utf-8 blob that follows them,
+                 strings are sorted so their index order is their byte order
+        roles    role count entries of (id, name, first permission, permission count) (4I), sorted by id
+        users    user count entries of (id, first role, role count) (3I), sorted by id
+        lists    permission and role lists (I), each one sorted
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'FWSS'
+FORMAT = 1
+HEADER = struct.Struct('<4sHHQIII')
+ROLE = struct.Struct('<IIII')
+USER = struct.Struct('<III')
+INDEX = struct.Struct('<I')
+
+
+def build_snapshot(version, roles, users):
+    """
+        Returns the snapshot bytes
+
+        :param version: security version the data was read at
+        :param roles: iterable of (role id, role name, permission names)
+        :param users: iterable of (user id, role ids)
+    """
+    roles = [(role_id, name, set(names or ())) for role_id, name, names in roles]
+    users = [(user_id, set(role_ids or ())) for user_id, role_ids in users]
+    strings = set()
+    for role_id, name, names in roles:
+        strings.add(role_id)
+        strings.add(name or u'')
+        strings.update(names)
+    for user_id, role_ids in users:
+        strings.add(user_id)
+        strings.update(role_ids)
+    encoded = sorted(s.encode('utf-8') for s in strings)
+    index = dict((s.decode('utf-8'), i) for i, s in enumerate(encoded))
+
+    lists = []
+    role_entries = []
+    for role_id, name, names in sorted(roles, key=lambda role: index[role[0]]):
+        ids = sorted(index[n] for n in names)
+        role_entries.append(ROLE.pack(index[role_id], index[name or u''], len(lists), len(ids)))
+        lists.extend(ids)
+    user_entries = []
+    for user_id, role_ids in sorted(users, key=lambda user: index[user[0]]):
+        ids = sorted(index[r] for r in role_ids)
+        user_entries.append(USER.pack(index[user_id], len(lists), len(ids)))
+        lists.extend(ids)
+
+    offsets = [0]
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    return b''.join([
+        HEADER.pack(MAGIC, FORMAT, 0, version, len(encoded), len(role_entries), len(user_entries)),
+        struct.pack('<{0}I'.format(len(offsets)), *offsets),
+        b''.join(encoded),
+        b''.join(role_entries),
+        b''.join(user_entries),
+        struct.pack('<{0}I'.format(len(lists)), *lists),
+    ])
+
+
+class _Table(object):
+    """
+        Sequence view over fixed size records of the snapshot, for bisect
+    """
+    def __init__(self, buf, offset, count, record, field=0):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.record = record
+        self.field = field
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.record.unpack_from(self.buf, self.offset + i * self.record.size)[self.field]
+
+
+class SecuritySnapshot(object):
+    """
+        Read only lookups over snapshot bytes or a memory map of them, nothing is copied up front
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        magic, fmt, _, self.version, n_strings, n_roles, n_users = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError("Not a security snapshot")
+        offset = HEADER.size
+        self._offsets = _Table(buf, offset, n_strings + 1, INDEX)
+        self._blob = offset + (n_strings + 1) * INDEX.size
+        self._n_strings = n_strings
+        offset = self._blob + self._offsets[n_strings]
+        self._roles = _Table(buf, offset, n_roles, ROLE)
+        offset += n_roles * ROLE.size
+        self._users = _Table(buf, offset, n_users, USER)
+        self._lists = offset + n_users * USER.size
+
+    def _string(self, i):
+        return bytes(self.buf[self._blob + self._offsets[i]:self._blob + self._offsets[i + 1]])
+
+    def _index(self, value):
+        encoded = value.encode('utf-8')
+        lo, hi = 0, self._n_strings
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n_strings and self._string(lo) == encoded:
+            return lo
+        return None
+
+    def _find(self, table, value):
+        i = self._index(value)
+        if i is None:
+            return None
+        pos = bisect_left(table, i)
+        if pos < len(table) and table[pos] == i:
+            return table.record.unpack_from(table.buf, table.offset + pos * table.record.size)
+        return None
+
+    def _list(self, start, count):
+        return _Table(self.buf, self._lists + start * INDEX.size, count, INDEX)
+
+    def role_id(self, name):
+        """
+            Returns the id of the role called name, roles are few so this is a linear search
+        """
+        encoded = name.encode('utf-8')
+        for i in range(len(self._roles)):
+            role_idx, name_idx, _, _ = ROLE.unpack_from(self.buf, self._roles.offset + i * ROLE.size)
+            if self._string(name_idx) == encoded:
+                return self._string(role_idx).decode('utf-8')
+        return None
+
+    def role_has(self, role_id, name):
+        """
+            Returns True if role_id has the 'permission|view_menu' name
+        """
+        role = self._find(self._roles, role_id)
+        name_idx = self._index(name)
+        if role is None or name_idx is None:
+            return False
+        names = self._list(role[2], role[3])
+        pos = bisect_left(names, name_idx)
+        return pos < len(names) and names[pos] == name_idx
+
+    def has_access(self, role_ids, name):
+        return any(self.role_has(role_id, name) for role_id in role_ids or ())
+
+    def user_role_ids(self, user_id):
+        """
+            Returns the role ids of a user, None if the user is not in the snapshot
+        """
+        user = self._find(self._users, user_id)
+        if user is None:
+            return None
+        return [self._string(i).decode('utf-8') for i in self._list(user[1], user[2])]
+
+
+class SnapshotFile(object):
+    """
+        A snapshot file shared by the workers of a host. Whoever needs a newer version than the
+        file has rebuilds it under an exclusive file lock, everyone else maps the new file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._current = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return SecuritySnapshot(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+
+    def _write(self, data):
+        tmp_path = '{0}.{1}'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def get(self, version, build):
+        """
+            Returns a snapshot at least as recent as version
+
+            :param build: callable returning (roles, users) as expected by build_snapshot
+        """
+        current = self._current
+        if current is not None and current.version >= version:
+            return current
+        with self._lock:
+            current = self._current
+            if current is not None and current.version >= version:
+                return current
+            snapshot = self._open()
+            if snapshot is None or snapshot.version < version:
+                with open(self.path + '.lock', 'a') as lock_file:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                    try:
+                        # another worker may have built it while we waited for the lock
+                        snapshot = self._open()
+                        if snapshot is None or snapshot.version < version:
+                            roles, users = build()
+                            self._write(build_snapshot(version, roles, users))
+                            snapshot = self._open()
+                            log.debug("Built the security snapshot for version {0}".format(version))
+                    finally:
+                        if fcntl is not None:
+                            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            # the previous map stays valid for threads still using it, and is closed once unreferenced
+            self._current = snapshot
+            return snapshot
@@ -0,0 +1,118 @@
+import logging
+from collections import OrderedDict
+
+from flask import g, has_app_context
+
+log = logging.getLogger(__name__)
+
+
+class UnitOfWork(object):
+    """
+        Collects independent saves and deletes and writes them together, with one
+        BatchWriteItem per table and 25 items (chunked and retried by dynamo3).
+        Saves overwrite, so only use it for items that need no write conditions.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self._saves = OrderedDict()
+        self._deletes = OrderedDict()
+        self._callbacks = []
+
+    def __len__(self):
+        return len(self._saves) + len(self._deletes)
+
+    @staticmethod
+    def _key(item):
+        meta = item.meta_
+        key = (meta.name, getattr(item, meta.hash_key.name))
+        if meta.range_key is not None:
+            key += (getattr(item, meta.range_key.name),)
+        return key
+
+    def save(self, *items):
+        for item in items:
+            key = self._key(item)
+            self._deletes.pop(key, None)
+            self._saves[key] = item
+
+    def delete(self, *items):
+        for item in items:
+            key = self._key(item)
+            self._saves.pop(key, None)
+            self._deletes[key] = item
+
+    def on_flush(self, callback):
+        """
+            Registers a callable without arguments to run once the writes are done,
+            for the cache, index and listener work that has to follow a write
+        """
+        self._callbacks.append(callback)
+
+    def flush(self):
+        saves, deletes, callbacks = list(self._saves.values()), list(self._deletes.values()), self._callbacks
+        self.rollback()
+        # validate everything before writing anything, like engine.save does per item
+        for item in saves:
+            item.pre_save_(self.engine)
+        tables = OrderedDict()
+        for item in saves:
+            tables.setdefault(item.meta_.ddb_tablename(self.engine.namespace), ([], []))[0].append(item)
+        for item in deletes:
+            tables.setdefault(item.meta_.ddb_tablename(self.engine.namespace), ([], []))[1].append(item)
+        for tablename, (table_saves, table_deletes) in tables.items():
+            with self.engine.dynamo.batch_write(tablename) as batch:
+                for item in table_saves:
+                    batch.put(item.ddb_dump_())
+                for item in table_deletes:
+                    batch.delete(item.pk_dict_)
+        for item in saves:
+            item.post_save_()
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self._saves = OrderedDict()
+        self._deletes = OrderedDict()
+        self._callbacks = []
+
+
+def get_unit_of_work():
+    """
+        Returns the unit of work of the current request, None outside requests
+        or when FLYWHEEL_UNIT_OF_WORK is off
+    """
+    if not has_app_context():
+        return None
+    return getattr(g, '_flywheel_unit_of_work', None)
+
+
+def install(app, engine):
+    """
+        Binds a unit of work to every request of app, it's flushed before the response is
+        sent, so write errors still turn into an error response, and dropped if the request failed
+    """
+    def begin():
+        g._flywheel_unit_of_work = UnitOfWork(engine)
+
+    def commit(response):
+        uow = get_unit_of_work()
+        if uow is not None:
+            if response.status_code < 400:
+                uow.flush()
+            else:
+                uow.rollback()
+        return response
+
+    def teardown(exc):
+        uow = g.pop('_flywheel_unit_of_work', None)
+        if uow is None or not len(uow):
+            return
+        if exc is None:
+            uow.flush()
+        else:
+            log.warning("Dropping {0} unwritten changes of a failed request".format(len(uow)))
+            uow.rollback()
+
+    app.before_request(begin)
+    app.after_request(commit)
+    app.teardown_request(teardown)
@@ -1,42 +1,525 @@
+import hashlib
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 from dynamo3 import Limit
+from dynamo3.batch import encode_query_kwargs
+from dynamo3.result import ResultSet
+from flywheel.query import Scan
+
+from fab_addon_flywheel import metrics
+from fab_addon_flywheel.cache import LRUCache, copy_items, get_item_cache, single_flight
+
+log = logging.getLogger(__name__)
+
+READ_EVENTUAL = 'eventual'
+READ_STRONG = 'strong'
+
+read_consistency_defaults = {
+    'list': READ_EVENTUAL,
+    'count': READ_EVENTUAL,
+    'relation': READ_EVENTUAL,
+    'get': READ_STRONG,
+    'auth': READ_STRONG,
+}
+""" Default read mode per kind of read """
+
+
+def get_read_mode(operation, model=None, overrides=None):
+    """
+        Returns the read mode (READ_EVENTUAL or READ_STRONG) for a kind of read.
+        A per interface override wins over the model's ``__read_consistency__``,
+        which wins over read_consistency_defaults.
+
+        :param operation: one of list, count, relation, get or auth
+        :param model: optional flywheel model class
+        :param overrides: optional dict of operation to read mode
+    """
+    if overrides and operation in overrides:
+        return overrides[operation]
+    model_modes = getattr(model, '__read_consistency__', None)
+    if model_modes and operation in model_modes:
+        return model_modes[operation]
+    return read_consistency_defaults.get(operation, READ_EVENTUAL)
+
+
+def is_consistent(operation, model=None, overrides=None, query=None):
+    """
+        Returns True if the read should be strongly consistent. Scans never are,
+        DynamoDB doesn't offer it and flywheel refuses them, so pass the scan as query
+        to read it eventually consistent whatever the read mode.
+    """
+    mode = get_read_mode(operation, model, overrides)
+    if mode == READ_STRONG and isinstance(query, Scan):
+        mode = READ_EVENTUAL
+    model_name = getattr(model, '__name__', str(model))
+    metrics.registry.counter('flywheel_reads_total', read=operation, model=model_name, mode=mode).inc()
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("{0} read on {1} ({2})".format(operation, model_name, mode))
+    return mode == READ_STRONG
+
+
+class PageBoundaryCache:
+    """
+        Keeps the exclusive start key of every page seen so far, per query signature,
+        so a deep page jump never has to walk the whole table again.
+        Shared by all requests, safe to use from threads and greenlets.
+    """
+    def __init__(self, max_signatures=256):
+        self.max_signatures = max_signatures
+        self._boundaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, signature):
+        """
+            Returns a copy of the known page boundaries for a query signature
+        """
+        with self._lock:
+            keys = self._boundaries.get(signature)
+            if keys is None:
+                return {0: None}
+            self._boundaries.move_to_end(signature)
+            return dict(keys)
+
+    def set(self, signature, page_num, key):
+        with self._lock:
+            keys = self._boundaries.get(signature)
+            if keys is None:
+                keys = {0: None}
+                self._boundaries[signature] = keys
+                while len(self._boundaries) > self.max_signatures:
+                    self._boundaries.popitem(last=False)
+            keys[page_num] = key
+
+    def discard(self, signature):
+        with self._lock:
+            self._boundaries.pop(signature, None)
+
+    def clear(self):
+        with self._lock:
+            self._boundaries.clear()
+
+
+page_boundaries = PageBoundaryCache()
+
+
+read_ahead_pages = LRUCache(maxsize=64, ttl=15)
+""" Pages fetched ahead of time, each one is handed out only once """
+
+_read_ahead_executor = None
+_read_ahead_lock = threading.Lock()
+
+
+def get_read_ahead_executor():
+    global _read_ahead_executor
+    with _read_ahead_lock:
+        if _read_ahead_executor is None:
+            _read_ahead_executor = ThreadPoolExecutor(max_workers=4)
+        return _read_ahead_executor
+
+
+class CapacityBudget:
+    """
+        Paces reads or writes to at most units_per_second consumed capacity units, None does not pace
+    """
+    def __init__(self, units_per_second=None):
+        self.units_per_second = units_per_second
+        self.started = time.time()
+        self.units = 0.0
+        self._lock = threading.Lock()
+
+    def spend(self, units):
+        with self._lock:
+            self.units += units
+            total = self.units
+        if not self.units_per_second:
+            return
+        ahead = total / self.units_per_second - (time.time() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class ScanStats:
+    """
+        Decayed totals of what the reads of each query signature scanned, returned,
+        consumed and took, so the next reads of a filtered query can be sized to fill a page
+    """
+    decay = 0.8
+
+    def __init__(self, maxsize=1024):
+        self._stats = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def observe(self, signature, usage, seconds):
+        if not usage.scanned:
+            return
+        with self._lock:
+            previous = self._stats.get(signature) or (0.0, 0.0, 0.0, 0.0)
+            self._stats.set(signature, tuple(
+                old * self.decay + new for old, new in
+                zip(previous, (usage.scanned, usage.returned, usage.read_units, seconds))))
+
+    def get(self, signature):
+        """
+            Returns (match ratio, read units per scanned item, seconds per scanned item) or None
+        """
+        stats = self._stats.get(signature)
+        if stats is None:
+            return None
+        scanned, returned, read_units, seconds = stats
+        return returned / scanned, read_units / scanned, seconds / scanned
+
+
+scan_stats = ScanStats()
+
+max_scan_request = 5000
+""" Upper bound of the items a single scan request evaluates, dynamo stops at 1MB anyway """
+
+
+_row_classes = {}
+_row_classes_lock = threading.Lock()
+
+
+def get_row_class(model, columns):
+    """
+        Returns a compact read only row class, with ``__slots__`` for columns,
+        to list items without hydrating full flywheel models
+    """
+    columns = tuple(columns)
+    key = (model, columns)
+    cls = _row_classes.get(key)
+    if cls is None:
+        with _row_classes_lock:
+            cls = _row_classes.get(key)
+            if cls is None:
+                cls = type(model.__name__ + 'Row', (ReadOnlyRow,), {
+                    '__slots__': columns,
+                    '__row_model__': model,
+                    '__row_columns__': columns,
+                })
+                _row_classes[key] = cls
+    return cls
+
+
+class ReadOnlyRow(object):
+    """
+        Base of the row classes built by get_row_class
+    """
+    __slots__ = ()
+    __row_model__ = None
+    __row_columns__ = ()
+
+    @classmethod
+    def from_ddb(cls, item):
+        """
+            Builds a row straight from a raw (projected) dynamo item
+        """
+        row = cls.__new__(cls)
+        fields = cls.__row_model__.meta_.fields
+        for name in cls.__row_columns__:
+            value = item.get(name)
+            if value is not None and name in fields:
+                value = fields[name].ddb_load(value)
+            object.__setattr__(row, name, value)
+        return row
+
+    @property
+    def meta_(self):
+        return self.__row_model__.meta_
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{0} is read only".format(self.__class__.__name__))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, ', '.join(
+            '{0}={1!r}'.format(name, getattr(self, name)) for name in self.__row_columns__))
+
+
+def query_signature(query, *extra):
+    """
+        Builds a hashable signature from the model, query type and conditions of a flywheel query
+    """
+    condition = getattr(query, 'condition', None)
+    state = ()
+    if condition is not None:
+        state = tuple(sorted((name, repr(value)) for name, value in vars(condition).items()))
+    # key set queries differ by their keys, not only by their conditions
+    state += (getattr(query, 'signature', None),)
+    return (query.__class__.__name__, query.model.meta_.name, state) + extra
 
 
 class FlywheelPager:
-    def __init__(self, model, query, page_size=0, sort_field=None, sort_desc=None):
+    """
+        Pages through a flywheel query, one pager is created per request,
+        only the page boundaries are shared between requests.
+    """
+    def __init__(self, model, query, page_size=0, sort_field=None, sort_desc=None, boundaries=None,
+                 consistent=False, read_ahead=False, columns=None, desc=False, key_names=None,
+                 time_budget=None, read_budget=None):
+        """
+            :param sort_field: sorts the items of each page, for queries without a global order
+            :param desc: reads an ordered (index) query in descending order
+            :param key_names: names of the attributes of the last evaluated key,
+                the table keys plus the index keys for index queries
+            :param time_budget: seconds a page read may take, it stops early with a partial page
+            :param read_budget: read units a page read may consume, it stops early with a partial page
+        """
         self.model = model
         self.query = query
+        self.consistent = consistent
+        self.read_ahead = read_ahead
+        self.desc = desc
+        self.key_names = key_names or get_key_names(model)
+        self.row_class = None
+        if columns:
+            self.row_class = get_row_class(
+                model, self.key_names + [col for col in columns if col not in self.key_names])
         self.curr_page = 0
         self.page_size = page_size
         self.sort_field = sort_field
         self.sort_desc = sort_desc
-        self.keys = {0: None}
+        self.boundaries = boundaries if boundaries is not None else page_boundaries
+        self.time_budget = time_budget
+        self.read_budget = read_budget
+        self.stats_signature = query_signature(query)
+        self.signature = query_signature(query, page_size, self.row_class, desc)
+        self.keys = self.boundaries.get(self.signature)
         self.last_evaluated_key = None
+        # page sizing and the read budget need the scanned counts and capacity, even with metrics off
+        metrics.install(query.engine, collect=False)
         self.set_page_size(page_size)
 
     def set_page_size(self, page_size):
         if page_size:
-            self.query = self.query.limit(Limit(item_limit=page_size, strict=True))
+            self.query = self.query.limit(self._get_limit(page_size))
+
+    def _get_limit(self, page_size):
+        """
+            Sizes the scan requests from the observed match ratio of this query, so a page of a
+            selective filter fills in as few requests as possible. strict=False keeps the whole last
+            request, _read cuts it to the page and the next page starts after the last item kept.
+        """
+        stats = scan_stats.get(self.stats_signature)
+        if stats is None:
+            return Limit(item_limit=page_size, min_scan_limit=page_size, strict=False)
+        ratio, units_per_item, seconds_per_item = stats
+        request = int(page_size / max(ratio, 1.0 / max_scan_request) * 1.25)
+        scan_limit = None
+        if self.read_budget and units_per_item:
+            scan_limit = int(self.read_budget / units_per_item)
+        if self.time_budget and seconds_per_item:
+            scan_limit = min(scan_limit or max_scan_request * 100, int(self.time_budget / seconds_per_item))
+        if scan_limit is not None:
+            scan_limit = max(scan_limit, page_size)
+        return Limit(scan_limit=scan_limit, item_limit=page_size,
+                     min_scan_limit=min(max(request, page_size), max_scan_request), strict=False)
+
+    def _read(self, key, attributes=None):
+        started = time.time()
+        results = []
+        with metrics.capture() as usage:
+            for item in self.query.gen(exclusive_start_key=key, attributes=attributes, consistent=self.consistent,
+                                       desc=self.desc):
+                results.append(item)
+                if self.page_size and len(results) >= self.page_size:
+                    break
+                if self.time_budget and time.time() - started > self.time_budget:
+                    break
+                if self.read_budget and usage.read_units > self.read_budget:
+                    break
+        scan_stats.observe(self.stats_signature, usage, time.time() - started)
+        return results
 
     def reset(self):
-        self.keys = {0: None}
+        self.boundaries.discard(self.signature)
+        self.keys = self.boundaries.get(self.signature)
+
+    def _remember(self, page_num, key):
+        self.keys[page_num] = key
+        self.boundaries.set(self.signature, page_num, key)
+
+    def _prefetch_keys(self, page_num):
+        """
+            Walks forward from the closest known boundary up to page_num,
+            reading only the key attributes of the skipped pages.
+        """
+        start = max(num for num in self.keys if num < page_num)
+        key = self.keys[start]
+        for num in range(start + 1, page_num + 1):
+            results = self._read(key, attributes=self.key_names)
+            if not results:
+                return
+            key = dict((name, results[-1][name]) for name in self.key_names)
+            self._remember(num, key)
+
+    def _fetch(self, key):
+        if self.row_class is not None:
+            results = self._read(key, attributes=list(self.row_class.__row_columns__))
+            return [self.row_class.from_ddb(item) for item in results]
+        return self._read(key)
+
+    def _boundary(self, item):
+        fields = self.model.meta_.fields
+        return dict((name, fields[name].ddb_dump(getattr(item, name))) for name in self.key_names)
+
+    def _read_ahead_key(self, page_num):
+        return self.signature, self.consistent, page_num
+
+    def _schedule_read_ahead(self, page_num):
+        """
+            Starts fetching page_num in a background thread, unless it is already on its way
+        """
+        cache_key = self._read_ahead_key(page_num)
+        if page_num not in self.keys or cache_key in read_ahead_pages:
+            return
+        future = get_read_ahead_executor().submit(self._fetch, self.keys[page_num])
+        read_ahead_pages.set(cache_key, future)
+
+    def _get_read_ahead(self, page_num):
+        future = read_ahead_pages.pop(self._read_ahead_key(page_num))
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            log.warning("Read ahead of page {0} failed {1}".format(page_num, str(e)))
+            return None
 
     def _get_page(self, page_num):
         if page_num not in self.keys:
-            self._get_page(page_num - 1)
+            self._prefetch_keys(page_num)
+            if page_num not in self.keys:
+                return []
         key = self.keys[page_num]
-        results = self.query.all(exclusive_start_key=key)
+        results = self._get_read_ahead(page_num) if self.read_ahead else None
+        if results is None:
+            results = self._fetch(key)
         if results:
-            self.keys[page_num+1] = self.model.meta_.pk_dict(results[-1], ddb_dump=True)
+            self._remember(page_num + 1, self._boundary(results[-1]))
         return results
 
     def page(self, page_num):
+        page_num = page_num or 0
         results = self._get_page(page_num)
+        if self.read_ahead and self.page_size and len(results) >= self.page_size:
+            self._schedule_read_ahead(page_num + 1)
 
-        if self.sort_field is not None:
-            results = sorted(results, key=lambda x: getattr(x, self.sort_field), reverse=self.sort_desc)
+        if self.sort_field:
+            results.sort(key=lambda x: getattr(x, self.sort_field), reverse=bool(self.sort_desc))
         return results
 
 
+def get_key_names(model):
+    names = [model.meta_.hash_key.name]
+    if model.meta_.range_key is not None:
+        names.append(model.meta_.range_key.name)
+    return names
+
+
+def get_item_key(model, item):
+    """
+        Returns the dynamo key of a raw (projected) item as returned by a scan with attributes
+    """
+    return dict((name, item[name]) for name in get_key_names(model))
+
+
+class KeySetQuery(object):
+    """
+        Stands in for a flywheel scan when a filter already resolved the exact primary keys
+        to list (from a reverse index for example). Pages are read with batch gets.
+
+        If more filters are applied on top of it, it falls back to the original scan
+        with the primary keys (or the given fallback condition) as one more filter.
+    """
+    max_in_keys = 100
+
+    def __init__(self, query, keys, fallback=None):
+        self.base = query
+        self.engine = query.engine
+        self.model = query.model
+        self.keys = sorted(set(keys))
+        self.fallback = fallback
+        # conditions applied before this one can't be answered with batch gets
+        self.filtered = query_signature(query) != query_signature(query.engine.scan(query.model))
+        self.item_limit = None
+        self.condition = query.condition
+        self.time_range = None
+        """ (column, after, before) when the keys come from a time bucket index """
+
+    @property
+    def signature(self):
+        """
+            Stable digest of the keys and the time range, so pages of different key sets
+            never share boundaries or read ahead results
+        """
+        digest = hashlib.sha1(repr((self.keys, self.time_range, self.filtered)).encode('utf-8'))
+        return digest.hexdigest()
+
+    @property
+    def _pk_name(self):
+        return self.model.meta_.hash_key.name
+
+    def _scan(self):
+        pk_field = self.model.field_(self._pk_name)
+        if self.fallback is None or len(self.keys) <= self.max_in_keys:
+            return self.base.filter(pk_field.in_(self.keys or [None]))
+        return self.base.filter(self.fallback)
+
+    def filter(self, *args, **kwargs):
+        self.base = self.base.filter(*args, **kwargs)
+        self.filtered = True
+        self.condition = self.base.condition
+        return self
+
+    def limit(self, limit):
+        self.item_limit = getattr(limit, 'item_limit', limit)
+        self.base = self.base.limit(limit)
+        return self
+
+    def count(self):
+        if self.filtered:
+            return self._scan().count()
+        return len(self.keys)
+
+    def all(self, exclusive_start_key=None, attributes=None, consistent=False, **kwargs):
+        if self.filtered:
+            query = self._scan()
+            return query.all(exclusive_start_key=exclusive_start_key, attributes=attributes,
+                             consistent=consistent and not isinstance(query, Scan), **kwargs)
+        keys = self.keys
+        if exclusive_start_key is not None:
+            last = exclusive_start_key[self._pk_name]
+            keys = [key for key in keys if key > last]
+        if self.item_limit:
+            keys = keys[:self.item_limit]
+        if not keys:
+            return []
+        if attributes is not None and set(attributes) <= {self._pk_name}:
+            return [{self._pk_name: key} for key in keys]
+        items = self.engine.get(self.model, [{self._pk_name: key} for key in keys], consistent=consistent)
+        items = sorted(items, key=lambda item: getattr(item, self._pk_name))
+        if attributes is not None:
+            # the raw values a scan with attributes returns
+            fields = self.model.meta_.fields
+            return [dict((name, fields[name].ddb_dump(getattr(item, name))) for name in attributes)
+                    for item in items]
+        return items
+
+    def gen(self, **kwargs):
+        return iter(self.all(**kwargs))
+
+    def first(self, **kwargs):
+        results = self.all(**kwargs)
+        return results[0] if results else None
+
+
 def get_primary_key(model):
     return model.meta_.hash_key.name
 
@@ -61,12 +544,106 @@ def get_sorted_fields(model):
     return [model.meta_.hash_key] + [model.meta_.fields[n] for n in keys if n != pk_name]
 
 
+def load_attributes(model, item):
+    """
+        Loads the values of a raw (projected) item into python values using the model's fields
+    """
+    fields = model.meta_.fields
+    return dict((name, fields[name].ddb_load(value) if name in fields else value) for name, value in item.items())
+
+
+def scan_segment(query, segment=None, total_segments=None, attributes=None):
+    """
+        Runs one segment of a parallel scan (the whole scan without a segment) with the
+        conditions of a flywheel scan, yields the raw items as returned by dynamo
+    """
+    engine = query.engine
+    kwargs = query.condition.scan_kwargs()
+    # Connection.scan takes no segment, so page the same legacy ScanFilter request with one
+    keywords = {
+        'TableName': query.model.meta_.ddb_tablename(engine.namespace),
+        'ReturnConsumedCapacity': engine.dynamo._default_capacity(None),
+    }
+    if segment is not None:
+        keywords['Segment'] = segment
+        keywords['TotalSegments'] = total_segments
+    if attributes is not None:
+        keywords['AttributesToGet'] = attributes
+    if kwargs:
+        keywords['ScanFilter'] = encode_query_kwargs(engine.dynamo.dynamizer, kwargs)
+        if len(kwargs) > 1:
+            keywords['ConditionalOperator'] = 'AND'
+    return ResultSet(engine.dynamo, Limit(), 'scan', **keywords)
+
+
+_scan_done = object()
+
+
+def parallel_scan(query, total_segments=1, attributes=None, max_buffer=1000):
+    """
+        Streams the raw items of a flywheel scan, reading total_segments segments
+        in parallel threads. Only max_buffer items are held in memory at any time.
+    """
+    if isinstance(query, KeySetQuery):
+        if not query.filtered:
+            for item in query.all(attributes=attributes):
+                yield item if attributes is not None else item.ddb_dump_()
+            return
+        query = query._scan()
+    if total_segments <= 1:
+        for item in scan_segment(query, attributes=attributes):
+            yield item
+        return
+
+    buffer = queue.Queue(maxsize=max_buffer)
+    errors = []
+    stop = threading.Event()
+
+    def worker(segment):
+        try:
+            for item in scan_segment(query, segment, total_segments, attributes):
+                if stop.is_set():
+                    break
+                buffer.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            buffer.put(_scan_done)
+
+    threads = [threading.Thread(target=worker, args=(segment,)) for segment in range(total_segments)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = total_segments
+        while running:
+            item = buffer.get()
+            if item is _scan_done:
+                running -= 1
+                continue
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        # unblock workers waiting on a full buffer
+        while any(thread.is_alive() for thread in threads):
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
 class FlywheelQueryHelper:
-    def __init__(self, engine, model, page_size=0):
-        self.flywheel_pager = None
+    def __init__(self, engine, model, page_size=0, read_consistency=None, read_ahead=False):
         self.engine = engine
         self.model = model
         self.page_size = page_size
+        self.read_consistency = read_consistency
+        self.read_ahead = read_ahead
+
+    def is_consistent(self, operation, model=None, query=None):
+        return is_consistent(operation, model or self.model, self.read_consistency, query)
 
     def get_fields(self, model=None):
         if model is None:
@@ -105,10 +682,22 @@ class FlywheelQueryHelper:
     def get_one(self, pk_value, model=None):
         if model is None:
             model = self.model
-        value = self.model.meta_.hash_key.data_type.data_type(pk_value)
+        value = model.meta_.hash_key.data_type.data_type(pk_value)
+        cache = get_item_cache(model)
+        if cache is not None:
+            item = cache.get(self.engine, value)
+            if item is not None:
+                return item
         pk_name = get_primary_key(model)
         keys = construct_keys_list(pk_name, value)
-        return self.engine.query(model).filter(**keys[0]).one()
+        consistent = self.is_consistent('get', model)
+        item = single_flight.do(
+            ('get', model.meta_.name, value, consistent),
+            lambda: self.engine.query(model).filter(**keys[0]).one(consistent=consistent),
+            lambda result: copy_items(self.engine, result))
+        if cache is not None:
+            cache.put(item)
+        return item
 
     def get_scan(self, model=None):
         if model is None:
@@ -123,16 +712,26 @@ class FlywheelQueryHelper:
     def get_all(self, model=None):
         if model is None:
             model = self.model
-        return self.engine.query(model).all()
+        return self.engine.query(model).all(consistent=self.is_consistent('relation', model))
+
+    def get_list(self, page=0, sort_field=None, sort_desc=False, query=None, page_size=None, columns=None,
+                 desc=False, key_names=None, time_budget=None, read_budget=None, **kwargs):
+        """
+            Returns a tuple of (count, items) for a page of query
 
-    def get_list(self, page=0, sort_field=None, sort_desc=False, query=None, page_size=0, **kwargs):
+            :param sort_field: sorts each page on its own, for queries without a global order
+            :param columns: if given, items are read only rows with only these columns
+            :param desc: reads an ordered query in descending order
+            :param key_names: key attribute names of an index query
+            :param time_budget: seconds a page read may take before returning a partial page
+            :param read_budget: read units a page read may consume before returning a partial page
+        """
 
-        if page_size != self.page_size:
-            self.page_size = page_size
+        if page_size is None:
+            page_size = self.page_size
 
         if query is None:
             query = self.get_scan()
-            self.flywheel_pager = None
 
         # TODO: Search
         # TODO: Filters
@@ -142,8 +741,10 @@ class FlywheelQueryHelper:
         # Get count
         count = query.count() if simple_list_pager is False else None
 
-        # Pagination
-        if self.flywheel_pager is None:
-            self.flywheel_pager = FlywheelPager(self.model, query, self.page_size, sort_field, sort_desc)
+        # Pagination, the pager only lives for this request
+        pager = FlywheelPager(self.model, query, page_size, sort_field, sort_desc,
+                              consistent=self.is_consistent('list', query=query), read_ahead=self.read_ahead,
+                              columns=columns, desc=desc, key_names=key_names, time_budget=time_budget,
+                              read_budget=read_budget)
 
-        return count, self.flywheel_pager.page(page)
+        return count, pager.page(page)
@@ -0,0 +1,82 @@
+import logging
+import random
+import threading
+import time
+
+from fab_addon_flywheel import metrics
+from fab_addon_flywheel.cache import get_item_cache
+from fab_addon_flywheel.utils import CapacityBudget
+
+log = logging.getLogger(__name__)
+
+ITEM_READ_UNITS = 0.5
+""" Read units of an eventually consistent read of a small item, used when capacity is not returned """
+
+
+def warm_model(engine, model, budget=None, lookup_fields=()):
+    """
+        Loads every item of model into its item cache. Models without one are skipped, enabling
+        a cache here would keep the items without the TTL and size the model was not tuned for.
+
+        :param budget: optional CapacityBudget of read units shared by the whole warm up
+        :param lookup_fields: fields also remembered for lookups, like a role's name
+        :return: the number of items loaded
+    """
+    cache = get_item_cache(model)
+    if cache is None:
+        log.warning("Not warming up {0}, it has no item cache".format(model.__name__))
+        return 0
+    budget = budget or CapacityBudget()
+    count = 0
+    with metrics.operation('warmup', model), metrics.capture() as usage:
+        spent = 0.0
+        for item in engine.scan(model).gen():
+            cache.put(item, *lookup_fields)
+            count += 1
+            units = max(usage.read_units, count * ITEM_READ_UNITS)
+            budget.spend(units - spent)
+            spent = units
+    return count
+
+
+def resolve_models(engine, models):
+    """
+        Returns model classes from a list of model classes or registered model names
+    """
+    resolved = []
+    for model in models or ():
+        if isinstance(model, str):
+            name = model
+            model = engine.models.get(name)
+            if model is None:
+                log.warning("Not warming up unknown model {0}".format(name))
+                continue
+        resolved.append(model)
+    return resolved
+
+
+def warm_up(appbuilder, models=(), jitter=0, read_budget=None):
+    """
+        Preloads the security tables and the given models into the item caches,
+        after a random delay of up to jitter seconds so workers don't read all at once
+    """
+    if jitter:
+        time.sleep(random.uniform(0, jitter))
+    start = time.time()
+    budget = CapacityBudget(read_budget)
+    engine = appbuilder.get_session
+    try:
+        security_count = appbuilder.sm.warm_up(budget)
+        count = sum(warm_model(engine, model, budget) for model in resolve_models(engine, models))
+        log.info("Flywheel warm up loaded {0} security and {1} other items in {2:.2f}s ({3:.1f} read units)".format(
+            security_count, count, time.time() - start, budget.units))
+    except Exception as e:
+        log.error("Error warming up the caches {0}".format(str(e)))
+
+
+def start_warm_up(appbuilder, models=(), jitter=0, read_budget=None):
+    thread = threading.Thread(target=warm_up, name='flywheel-warmup',
+                              args=(appbuilder, models, jitter, read_budget))
+    thread.daemon = True
+    thread.start()
+    return thread